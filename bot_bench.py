@@ -0,0 +1,346 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+from loguru import logger
+from telebot import types
+import bot_settings
+
+
+class FakeApi:
+
+    """
+    Локальная замена hotels4.p.rapidapi.com. Отвечает на четыре запроса, которые выполняет ApiQuest,
+    с заданной задержкой и заданным количеством страниц результатов поиска отелей, и считает запросы.
+    """
+
+    def __init__(self, latency: float, pages: int, pics: int):
+        """
+        первичная инициализация класса
+        :param latency: задержка ответа в секундах
+        :param pages: количество страниц в результатах поиска отелей
+        :param pics: количество изображений отеля
+        """
+        self.latency: float = latency
+        self.pages: int = pages
+        self.pics: int = pics
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self) -> str:
+        """
+        Запускает http-сервер на свободном порту
+        :return: адрес сервера
+        """
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), make_api_handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-api', daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def stop(self) -> None:
+        """
+        Останавливает http-сервер
+        """
+        self._server.shutdown()
+
+    def answer(self, path: str, query: Dict[str, str]) -> Optional[Dict]:
+        """
+        Формирует ответ на запрос
+        :param path: путь запроса, например /locations/search
+        :param query: параметры запроса
+        :return: ответ или None для неизвестного пути
+        """
+        with self._lock:
+            self.calls[path] += 1
+        time.sleep(self.latency)
+        if path == '/locations/search':
+            name = query['query'].capitalize()
+            return {'suggestions': [{'group': 'CITY_GROUP', 'entities': [
+                {'type': 'CITY', 'name': name, 'caption': f'{name}, Россия',
+                 'destinationId': str(zlib.crc32(name.encode('utf-8')))}]}]}
+        if path == '/properties/list':
+            page = int(query['pageNumber'])
+            base = int(query['destinationId']) % 100000 * 10000 + page * 100
+            results = [{'id': base + number, 'name': f'Отель {base + number}', 'starRating': number % 5 + 1,
+                        'address': {'streetAddress': f'ул. Тестовая, {number + 1}'},
+                        'ratePlan': {'price': {'exactCurrent': 1000 + 150 * number}},
+                        'landmarks': [{'label': 'Центр города', 'distance': f'{number % 10},{page % 10} км'}],
+                        'coordinate': {'lat': 55.75, 'lon': 37.61}}
+                       for number in range(int(query['pageSize']))]
+            pagination = {'currentPage': page}
+            if page < self.pages:
+                pagination['nextPageNumber'] = page + 1
+            return {'result': 'OK', 'data': {'body': {'searchResults': {'results': results,
+                                                                        'pagination': pagination}}}}
+        if path == '/properties/get-details':
+            return {'result': 'OK', 'data': {'body': {
+                'propertyDescription': {'name': f'Отель {query["id"]}',
+                                        'address': {'fullAddress': 'ул. Тестовая, 1, Москва'},
+                                        'featuredPrice': {'currentPrice': {'plain': 2500}}},
+                'pdpHeader': {'hotelLocation': {'coordinates': {'latitude': 55.75, 'longitude': 37.61}}},
+                'overview': {'overviewSections': [{'content': ['Бесплатный Wi-Fi', 'Завтрак включен']},
+                                                  {'content': ['Красная площадь', 'Парк Горького']}]}}}}
+        if path == '/properties/get-hotel-photos':
+            return {'hotelImages': [{'baseUrl': f'https://example.com/{query["id"]}/{number}_{{size}}.jpg'}
+                                    for number in range(self.pics)]}
+        return None
+
+
+def make_api_handler(api: FakeApi):
+    """
+    Создает класс обработчика http-запросов локальной замены API
+    :param api: замена API
+    :return: класс обработчика
+    """
+
+    class FakeApiHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            answer = api.answer(url.path, {key: value[0] for key, value in parse_qs(url.query).items()})
+            if answer is None:
+                self.send_error(404)
+                return
+            body = json.dumps(answer, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return FakeApiHandler
+
+
+class FakeBot:
+
+    """
+    Замена чат-бота TeleBot. Не обращается к Telegram, считает отправленные сообщения
+    и запоминает последнюю клавиатуру каждого чата.
+    """
+
+    def __init__(self, latency: float):
+        """
+        первичная инициализация класса
+        :param latency: задержка отправки сообщения в секундах
+        """
+        self.latency: float = latency
+        self.sent: Counter = Counter()
+        self.keyboards: Dict[int, types.InlineKeyboardMarkup] = {}
+        self._lock = threading.Lock()
+
+    def _send(self, method: str, chat_id: int, text: str = '') -> types.Message:
+        """
+        Имитирует отправку сообщения
+        :param method: название метода TeleBot
+        :param chat_id: id чата
+        :param text: текст сообщения
+        :return: отправленное сообщение
+        """
+        with self._lock:
+            self.sent[method] += 1
+        time.sleep(self.latency)
+        return make_message(chat_id, text)
+
+    def send_message(self, chat_id: int, text: str, reply_markup=None, **kwargs) -> types.Message:
+        if reply_markup is not None:
+            self.keyboards[chat_id] = reply_markup
+        return self._send('send_message', chat_id, text)
+
+    def send_media_group(self, chat_id: int, media: List, **kwargs) -> List[types.Message]:
+        return [self._send('send_media_group', chat_id)]
+
+    def send_photo(self, chat_id: int, photo: str, **kwargs) -> types.Message:
+        return self._send('send_photo', chat_id)
+
+    def edit_message_reply_markup(self, chat_id: int, message_id: int, **kwargs) -> types.Message:
+        return self._send('edit_message_reply_markup', chat_id)
+
+    def first_hotel(self, chat_id: int) -> Optional[str]:
+        """
+        Возвращает id первого отеля из последней клавиатуры чата
+        :param chat_id: id чата
+        :return: id отеля или None, если клавиатура не содержит отелей
+        """
+        for row in self.keyboards[chat_id].keyboard:
+            for button in row:
+                if button.callback_data.endswith('.hot'):
+                    return button.callback_data.split(sep='.')[0]
+        return None
+
+
+class QueryCounter(logging.Handler):
+
+    """
+    Считает запросы к базе данных по отладочным сообщениям peewee
+    """
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count: int = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.count += 1
+
+
+def make_message(chat_id: int, text: str) -> types.Message:
+    """
+    Создает сообщение пользователя в чате
+    :param chat_id: id чата
+    :param text: текст сообщения
+    :return: сообщение
+    """
+    return types.Message.de_json({'message_id': 1, 'date': int(time.time()), 'text': text,
+                                  'chat': {'id': chat_id, 'type': 'private'},
+                                  'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}})
+
+
+def make_call(chat_id: int, data: str) -> types.CallbackQuery:
+    """
+    Создает вызов из inline-клавиатуры. Как и в Telegram, вызов содержит сообщение бота с клавиатурой.
+    :param chat_id: id чата
+    :param data: возвращаемое значение нажатой кнопки
+    :return: вызов
+    """
+    return types.CallbackQuery.de_json({'id': str(chat_id), 'data': data, 'chat_instance': str(chat_id),
+                                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+                                        'message': {'message_id': 1, 'date': int(time.time()),
+                                                    'text': 'Выберите действие',
+                                                    'chat': {'id': chat_id, 'type': 'private'}}})
+
+
+def run_search(bot: FakeBot, chat_id: int, command: str, city: str) -> Dict[str, float]:
+    """
+    Проходит цепочку опроса пользователя от команды до вывода изображений выбранного отеля,
+    передавая ответы пользователя тем же обработчикам, что и main.py
+    :param bot: замена чат-бота
+    :param chat_id: id чата
+    :param command: команда поиска: /lowprice, /highprice или /bestdeal
+    :param city: название города
+    :return: длительность этапов цепочки в секундах
+    """
+    import bots_funcs
+    import bot_steps
+    check_in = datetime.date.today() + datetime.timedelta(days=1)
+    check_out = check_in + datetime.timedelta(days=3)
+    answers = [('city', city), ('hot_num', '10')]
+    if command == '/bestdeal':
+        answers += [('distance', '5'), ('max_price', '10000')]
+    answers.append(('persons', '2'))
+    timings: Dict[str, float] = {}
+
+    def timed(stage: str, func, *args) -> None:
+        started = time.perf_counter()
+        func(*args)
+        timings[stage] = time.perf_counter() - started
+
+    chain_started = time.perf_counter()
+    timed('command', bots_funcs.command_router, bot, make_message(chat_id, command))
+    timed('lang', bots_funcs.get_lang, 'ru_RU', make_call(chat_id, 'ru_RU.loc'), bot)
+    for stage, text in answers:
+        timed(stage, bot_steps.resume_step, bot, make_message(chat_id, text))
+    timed('check_in', bots_funcs.set_date, make_call(chat_id, f'calendar_1:DAY:{check_in.year}:'
+                                                               f'{check_in.month}:{check_in.day}'))
+    timed('search', bots_funcs.set_date, make_call(chat_id, f'calendar_2:DAY:{check_out.year}:'
+                                                             f'{check_out.month}:{check_out.day}'))
+    hotel_id = bot.first_hotel(chat_id)
+    if hotel_id is None:
+        raise RuntimeError(f'Цепочка чата {chat_id} не нашла ни одного отеля')
+    timed('hotel', bots_funcs.chosen_hotel, hotel_id, make_call(chat_id, hotel_id + '.hot'), bot)
+    timed('pics_number', bots_funcs.get_picts, hotel_id, make_message(chat_id, ''), bot, 'h_pic')
+    timed('pics', bot_steps.resume_step, bot, make_message(chat_id, '5'))
+    timings['chain'] = time.perf_counter() - chain_started
+    return timings
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Возвращает перцентиль выборки методом ближайшего ранга
+    :param values: отсортированная выборка
+    :param share: доля от 0 до 1
+    :return: значение перцентиля
+    """
+    return values[min(len(values) - 1, max(0, int(share * len(values) + 0.5) - 1))]
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Запускает нагрузочный тест цепочки поиска и выводит результат
+    :param args: параметры теста из командной строки
+    """
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    api = FakeApi(args.api_latency, args.pages, args.pics)
+    bot_settings.API_BASE_URL = api.start()
+    import bots_funcs
+    from bot_classes import db, db_pragmas
+    from bot_database import create_tables
+    from bot_state import session_store
+    bot = FakeBot(args.tg_latency)
+    bots_funcs.bot = bot
+    queries = QueryCounter()
+    peewee_logger = logging.getLogger('peewee')
+    peewee_logger.setLevel(logging.DEBUG)
+    peewee_logger.propagate = False
+    peewee_logger.addHandler(queries)
+    with tempfile.TemporaryDirectory() as folder:
+        db.init(os.path.join(folder, 'bench.db'), pragmas=db_pragmas(), timeout=bot_settings.DB_BUSY_TIMEOUT)
+        for one_model in ('Session', 'History', 'NextStep'):
+            create_tables(one_model)
+        session_store.journal = os.path.join(folder, 'journal.log')
+        session_store.start()
+        queries.count = 0
+        timings: Dict[str, List[float]] = defaultdict(list)
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = executor.map(lambda chat_id: run_search(bot, chat_id, args.command,
+                                                                  f'город{chat_id % args.cities}'),
+                                       range(1, args.searches + 1))
+                for one_result in results:
+                    for stage, seconds in one_result.items():
+                        timings[stage].append(seconds)
+            elapsed = time.perf_counter() - started
+        finally:
+            session_store.stop()
+            db.close()
+    api.stop()
+    print(f'Поисков: {args.searches}, одновременно: {args.concurrency}, команда: {args.command}, '
+          f'городов: {args.cities}, страниц: {args.pages}, задержка API: {args.api_latency * 1000:.0f} мс')
+    print(f'Время: {elapsed:.2f} с, пропускная способность: {args.searches / elapsed:.1f} поисков в секунду')
+    print(f'{"этап":<12}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+    for stage, values in timings.items():
+        values.sort()
+        print(f'{stage:<12}' + ''.join(f'{percentile(values, share) * 1000:>10.1f}' for share in (0.5, 0.95, 0.99)))
+    print(f'Запросов к API на поиск: {sum(api.calls.values()) / args.searches:.2f} '
+          f'({", ".join(f"{path} {count / args.searches:.2f}" for path, count in sorted(api.calls.items()))})')
+    print(f'Запросов к базе данных на поиск: {queries.count / args.searches:.2f}')
+    print(f'Сообщений Telegram на поиск: {sum(bot.sent.values()) / args.searches:.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный тест цепочки поиска отелей')
+    parser.add_argument('--searches', type=int, default=200, help='количество поисков')
+    parser.add_argument('--concurrency', type=int, default=bot_settings.HANDLER_WORKERS,
+                        help='количество одновременных чатов')
+    parser.add_argument('--command', default='/lowprice', choices=['/lowprice', '/highprice', '/bestdeal'])
+    parser.add_argument('--cities', type=int, default=20, help='количество разных городов в поисках')
+    parser.add_argument('--pages', type=int, default=5, help='количество страниц результатов поиска отелей')
+    parser.add_argument('--pics', type=int, default=10, help='количество изображений отеля')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='задержка ответа API в секундах')
+    parser.add_argument('--tg-latency', type=float, default=0.0, help='задержка отправки в Telegram в секундах')
+    main(parser.parse_args())
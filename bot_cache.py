@@ -0,0 +1,278 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+from loguru import logger
+import bot_metrics
+
+
+class SqliteCacheTier:
+
+    """
+    Постоянный уровень кэша, хранящий записи в таблице базы данных sqlite.
+    Переживает перезапуск бота.
+    """
+
+    def __init__(self, database, table: str):
+        """
+        первичная инициализация класса
+        :param database: база данных peewee
+        :param table: имя таблицы для хранения записей кэша
+        """
+        self.database = database
+        self.table: str = table
+        self._ready: bool = False
+
+    def _prepare(self) -> None:
+        """
+        Создает таблицу кэша, если она отсутствует
+        """
+        if not self._ready:
+            self.database.execute_sql(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                                      f'(key TEXT PRIMARY KEY, value TEXT NOT NULL, t_stamp REAL NOT NULL)')
+            self._ready = True
+
+    def get(self, key: str, ttl: float) -> Optional[Any]:
+        """
+        Возвращает значение из таблицы, если оно не устарело
+        :param key: ключ записи
+        :param ttl: время жизни записи в секундах
+        :return: значение или None
+        """
+        self._prepare()
+        row = self.database.execute_sql(f'SELECT value, t_stamp FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Сохраняет значение в таблицу
+        :param key: ключ записи
+        :param value: сериализуемое в json значение
+        """
+        self._prepare()
+        self.database.execute_sql(f'INSERT OR REPLACE INTO {self.table} (key, value, t_stamp) VALUES (?, ?, ?)',
+                                  (key, json.dumps(value, ensure_ascii=False), time.time()))
+
+    def trim(self, ttl: float) -> int:
+        """
+        Удаляет из таблицы устаревшие записи
+        :param ttl: время жизни записи в секундах
+        :return: количество удаленных записей
+        """
+        self._prepare()
+        return self.database.execute_sql(f'DELETE FROM {self.table} WHERE t_stamp < ?',
+                                         (time.time() - ttl,)).rowcount
+
+
+class TTLCache:
+
+    """
+    Потокобезопасный кэш в памяти с ограниченным временем жизни записей и вытеснением
+    давно не использованных записей (LRU). Может дополняться постоянным уровнем в базе данных.
+    Поддерживает ограничение по суммарному размеру записей и выдачу устаревших записей
+    с фоновым обновлением (stale-while-revalidate).
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, persistent: Optional[SqliteCacheTier] = None,
+                 max_bytes: int = 0, stale_ttl: float = 0):
+        """
+        первичная инициализация класса
+        :param name: имя кэша, используется в логах
+        :param maxsize: максимальное количество записей в памяти
+        :param ttl: время жизни записи в секундах
+        :param persistent: постоянный уровень кэша, необязательный
+        :param max_bytes: максимальный суммарный размер записей в байтах, 0 - без ограничения
+        :param stale_ttl: сколько секунд после истечения ttl запись еще можно отдавать, обновляя ее в фоне
+        """
+        self.name: str = name
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.persistent: Optional[SqliteCacheTier] = persistent
+        self.max_bytes: int = max_bytes
+        self.stale_ttl: float = stale_ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self.stale_hits: int = 0
+        self._bytes: int = 0
+        self._data: OrderedDict = OrderedDict()
+        self._refreshing: set = set()
+        self._lock = threading.Lock()
+        bot_metrics.register_cache(self)
+
+    @staticmethod
+    def _key_string(key: Hashable) -> str:
+        """
+        Преобразует ключ в строку для постоянного уровня
+        :param key: ключ записи
+        :return: строковое представление ключа
+        """
+        return json.dumps(key, ensure_ascii=False)
+
+    def _lookup(self, key: Hashable, now: float) -> Optional[tuple]:
+        """
+        Ищет запись в памяти, удаляя окончательно устаревшие. Вызывается под блокировкой.
+        :return: кортеж (значение, признак свежести) или None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        age = now - entry[1]
+        if age > self.ttl + self.stale_ttl:
+            self._discard(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[0], age <= self.ttl
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение из кэша. Сначала ищет в памяти, затем в постоянном уровне.
+        :param key: ключ записи
+        :return: значение или None, если записи нет или она устарела
+        """
+        now = time.time()
+        with self._lock:
+            found = self._lookup(key, now)
+            if found is not None and found[1]:
+                self.hits += 1
+                return found[0]
+        value = None
+        if self.persistent is not None:
+            try:
+                value = self.persistent.get(self._key_string(key), self.ttl)
+            except Exception as err:
+                logger.warning('Ошибка чтения постоянного кэша {}: {}', self.name, err)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, value, now)
+        return value
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        Возвращает значение из кэша, а при его отсутствии получает значение вызовом loader.
+        Если запись устарела, но не более чем на stale_ttl, отдает ее сразу
+        и запускает обновление в фоновом потоке.
+        Пустые значения в кэш не сохраняются.
+        :param key: ключ записи
+        :param loader: функция без аргументов, получающая свежее значение
+        :return: значение
+        """
+        with self._lock:
+            found = self._lookup(key, time.time())
+            if found is not None:
+                if found[1]:
+                    self.hits += 1
+                    return found[0]
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                return found[0]
+        value = self.get(key) if self.persistent is not None else None
+        if value is None:
+            if self.persistent is None:
+                with self._lock:
+                    self.misses += 1
+            value = loader()
+            if value:
+                self.put(key, value)
+        return value
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Возвращает значение из памяти, а при его отсутствии создает значение вызовом factory и сохраняет его.
+        Поиск и создание выполняются под одной блокировкой, поэтому одновременные вызовы с одним ключом
+        создают значение один раз. factory должна выполняться быстро, например только запускать задачу
+        в пуле потоков. Постоянный уровень не используется.
+        :param key: ключ записи
+        :param factory: функция без аргументов, создающая значение
+        :return: значение
+        """
+        now = time.time()
+        with self._lock:
+            found = self._lookup(key, now)
+            if found is not None and found[1]:
+                self.hits += 1
+                return found[0]
+            self.misses += 1
+            value = factory()
+            self._store(key, value, now)
+        return value
+
+    def discard(self, key: Hashable, value: Any) -> None:
+        """
+        Удаляет запись из памяти, если в ней все еще хранится значение value
+        :param key: ключ записи
+        :param value: удаляемое значение
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is value:
+                self._discard(key)
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Any]) -> None:
+        """
+        Обновляет устаревшую запись в фоновом потоке
+        :param key: ключ записи
+        :param loader: функция без аргументов, получающая свежее значение
+        """
+        try:
+            value = loader()
+            if value:
+                self.put(key, value)
+                logger.info('Запись кэша {} обновлена в фоне', self.name)
+        except Exception as err:
+            logger.warning('Ошибка фонового обновления кэша {}: {}', self.name, err)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Сохраняет значение в кэш и в постоянный уровень
+        :param key: ключ записи
+        :param value: значение
+        """
+        with self._lock:
+            self._store(key, value, time.time())
+        if self.persistent is not None:
+            try:
+                self.persistent.put(self._key_string(key), value)
+            except Exception as err:
+                logger.warning('Ошибка записи постоянного кэша {}: {}', self.name, err)
+
+    def _store(self, key: Hashable, value: Any, t_stamp: float) -> None:
+        """
+        Помещает запись в память и вытесняет самые старые записи сверх maxsize и max_bytes.
+        Вызывается под блокировкой.
+        """
+        size = len(json.dumps(value, ensure_ascii=False).encode('utf-8')) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        self._discard(key)
+        self._data[key] = (value, t_stamp, size)
+        self._bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes and self._bytes > self.max_bytes):
+            self._bytes -= self._data.popitem(last=False)[1][2]
+
+    def _discard(self, key: Hashable) -> None:
+        """
+        Удаляет запись из памяти. Вызывается под блокировкой.
+        """
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает счетчики попаданий и промахов кэша
+        :return: словарь со статистикой
+        """
+        with self._lock:
+            return {'size': len(self._data), 'bytes': self._bytes, 'hits': self.hits,
+                    'stale_hits': self.stale_hits, 'misses': self.misses}
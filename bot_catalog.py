@@ -0,0 +1,201 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+import numpy
+import bot_metrics
+
+# Числовые столбцы каталога
+COLUMNS: Tuple[str, ...] = ('price', 'distance_km', 'stars', 'lat', 'lon', 'fetched_at')
+
+
+class CatalogSlice:
+
+    """
+    Отели одного направления (destinationId) для одного набора условий предложения: дат, количества гостей,
+    валюты и языка, от которых зависят цены. Числовые поля хранятся по столбцам в массивах NumPy
+    с запасом емкости, поэтому отбор и сортировка выполняются векторно, без цикла по строкам.
+    Цена дополнительно хранится в том виде, в котором ее вернул API, чтобы восстановленная запись
+    выводилась так же, как полученная из ответа; отель без цены хранится с ценой NaN и не отбирается.
+    Для каждого отеля хранится одна строка, повторно полученный отель обновляет свою строку.
+    """
+
+    def __init__(self):
+        """
+        первичная инициализация класса
+        """
+        self.ids: List[str] = []
+        self.names: List[str] = []
+        self.addresses: List[str] = []
+        self.prices: List[Any] = []
+        self.columns: Dict[str, numpy.ndarray] = {column: numpy.empty(16) for column in COLUMNS}
+        self.rows: Dict[str, int] = {}
+        # Покрытие последнего обхода страниц, отсортированных по расстоянию: максимальная цена запроса,
+        # расстояние, до которого получены все отели, и время обхода
+        self.price_max: float = 0.0
+        self.covered_km: float = -1.0
+        self.scanned_at: float = 0.0
+
+    def add(self, hotel: Any, now: float) -> None:
+        """
+        Добавляет или обновляет строку отеля
+        :param hotel: запись об отеле с полями HotelRecord
+        :param now: время получения
+        """
+        values = tuple(math.nan if value is None else value for value in
+                       (hotel.price, hotel.distance_km, hotel.stars, hotel.lat, hotel.lon, now))
+        row = self.rows.get(hotel.id)
+        if row is None:
+            row = self.rows[hotel.id] = len(self.ids)
+            self.ids.append(hotel.id)
+            self.names.append(hotel.name)
+            self.addresses.append(hotel.address)
+            self.prices.append(hotel.price)
+            if row == len(self.columns['price']):
+                self.columns = {column: numpy.resize(values, row * 2) for column, values in self.columns.items()}
+        else:
+            self.names[row] = hotel.name
+            self.addresses[row] = hotel.address
+            self.prices[row] = hotel.price
+        for column, value in zip(COLUMNS, values):
+            self.columns[column][row] = value
+
+    def select(self, price_min: float, price_max: float, distance: float, fresh_after: float,
+               limit: int) -> List[int]:
+        """
+        Отбирает строки по цене, расстоянию и времени получения и упорядочивает их по расстоянию
+        :param price_min: минимальная цена
+        :param price_max: максимальная цена
+        :param distance: максимальное расстояние до центра в километрах
+        :param fresh_after: строки, полученные раньше этого времени, не учитываются
+        :param limit: максимальное количество строк
+        :return: номера строк
+        """
+        size = len(self.ids)
+        price, distance_km, fetched_at = (self.columns[column][:size]
+                                          for column in ('price', 'distance_km', 'fetched_at'))
+        rows = numpy.flatnonzero((price >= price_min) & (price <= price_max) & (distance_km <= distance)
+                                 & (fetched_at >= fresh_after))
+        return rows[numpy.argsort(distance_km[rows], kind='stable')][:limit].tolist()
+
+    def record(self, record_type: Any, row: int) -> Any:
+        """
+        Восстанавливает запись об отеле по номеру строки
+        :param record_type: класс записи, HotelRecord
+        :param row: номер строки
+        :return: запись об отеле
+        """
+        lat, lon = float(self.columns['lat'][row]), float(self.columns['lon'][row])
+        return record_type(id=self.ids[row], name=self.names[row], stars=float(self.columns['stars'][row]),
+                           address=self.addresses[row], price=self.prices[row],
+                           distance_km=float(self.columns['distance_km'][row]),
+                           lat=None if math.isnan(lat) else lat, lon=None if math.isnan(lon) else lon)
+
+
+class HotelCatalog:
+
+    """
+    Каталог всех отелей, полученных в ответах properties/list, по направлениям.
+    Запрос /bestdeal к направлению, недавно просмотренному с сортировкой по расстоянию,
+    выполняется фильтрацией каталога, без обращения к API.
+    """
+
+    def __init__(self, record_type: Any, ttl: float, max_slices: int):
+        """
+        первичная инициализация класса
+        :param record_type: класс записи об отеле, HotelRecord
+        :param ttl: сколько секунд данные каталога считаются актуальными, 0 - каталог не используется
+        :param max_slices: максимальное количество хранимых наборов, давно не использованные удаляются
+        """
+        self.name: str = 'catalog'
+        self.record_type: Any = record_type
+        self.ttl: float = ttl
+        self.max_slices: int = max_slices
+        self.hits: int = 0
+        self.misses: int = 0
+        self._slices: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        bot_metrics.register_cache(self)
+
+    def _slice(self, key: Hashable) -> CatalogSlice:
+        """
+        Возвращает набор отелей по ключу, создавая его при необходимости. Вызывается под блокировкой.
+        :param key: destinationId и условия предложения
+        :return: набор отелей
+        """
+        one_slice = self._slices.get(key)
+        if one_slice is None:
+            one_slice = self._slices[key] = CatalogSlice()
+            while len(self._slices) > self.max_slices:
+                self._slices.popitem(last=False)
+        self._slices.move_to_end(key)
+        return one_slice
+
+    def add(self, key: Hashable, hotels: Iterable[Any]) -> None:
+        """
+        Добавляет в каталог отели из ответа properties/list
+        :param key: destinationId и условия предложения
+        :param hotels: записи об отелях
+        """
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            one_slice = self._slice(key)
+            for one_hotel in hotels:
+                one_slice.add(one_hotel, now)
+
+    def scanned(self, key: Hashable, price_max: float, covered_km: float, started: float) -> None:
+        """
+        Запоминает результат обхода страниц, отсортированных по расстоянию: в каталоге есть все отели
+        дешевле price_max, расположенные ближе covered_km
+        :param key: destinationId и условия предложения
+        :param price_max: максимальная цена в запросе
+        :param covered_km: расстояние последнего полученного отеля, inf - получены все страницы
+        :param started: время начала обхода
+        """
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            one_slice = self._slice(key)
+            one_slice.price_max, one_slice.covered_km, one_slice.scanned_at = price_max, covered_km, started
+
+    def find(self, key: Hashable, price_min: float, price_max: float, distance: float,
+             hot_num: int) -> Optional[List[Any]]:
+        """
+        Отбирает из каталога hot_num ближайших к центру отелей в пределах цены и расстояния.
+        Ответ дается, только если последний обход направления актуален, выполнялся с той же или большей
+        максимальной ценой и гарантирует, что ближе найденных отелей других подходящих отелей нет.
+        :param key: destinationId и условия предложения
+        :param price_min: минимальная цена
+        :param price_max: максимальная цена
+        :param distance: максимальное расстояние до центра в километрах
+        :param hot_num: необходимое количество отелей
+        :return: список записей об отелях или None, если нужно обратиться к API
+        """
+        if self.ttl <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            one_slice = self._slices.get(key)
+            if one_slice is None or now - one_slice.scanned_at > self.ttl or price_max > one_slice.price_max:
+                self.misses += 1
+                return None
+            rows = one_slice.select(price_min, price_max, distance, now - self.ttl, hot_num)
+            last_km = float(one_slice.columns['distance_km'][rows[-1]]) if rows else math.inf
+            if distance >= one_slice.covered_km and (len(rows) < hot_num or last_km >= one_slice.covered_km):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._slices.move_to_end(key)
+            return [one_slice.record(self.record_type, row) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает счетчики ответов из каталога и обращений к API, количество отелей в каталоге
+        :return: словарь со статистикой
+        """
+        with self._lock:
+            return {'size': sum(len(one_slice.ids) for one_slice in self._slices.values()), 'hits': self.hits,
+                    'stale_hits': 0, 'misses': self.misses}
@@ -1,11 +1,73 @@
-from typing import List, Dict, Tuple
+import datetime
+import math
+import time
+from concurrent.futures import Future
+import json
+from typing import Any, List, Dict, NamedTuple, Tuple, Optional
 from telebot import types
 import requests
 import peewee
 from loguru import logger
+import bot_logging
+import bot_metrics
+import bot_transport
+import bot_settings
+from bot_cache import TTLCache, SqliteCacheTier
+from bot_catalog import HotelCatalog
 
+# Тексты ответа get_one_hotel при ошибке запроса
+SITE_ERROR: str = 'Произошла ошибка при обращении к сайту.'
+QUERY_ERROR: str = 'Запрос составлен неверно, обратитесь к администратору.'
 
-db = peewee.SqliteDatabase('bot_sessions.db')
+
+def db_pragmas() -> Dict[str, Any]:
+    """
+    Возвращает параметры sqlite из настроек. Параметры применяются к каждому новому соединению.
+    :return: словарь pragma
+    """
+    return {'journal_mode': bot_settings.DB_JOURNAL_MODE, 'synchronous': bot_settings.DB_SYNCHRONOUS,
+            'cache_size': bot_settings.DB_CACHE_SIZE, 'mmap_size': bot_settings.DB_MMAP_SIZE}
+
+
+def make_database(path: str) -> peewee.SqliteDatabase:
+    """
+    Создает объект базы данных. У каждого потока собственное соединение с базой,
+    ожидание блокировки базы другим соединением ограничено DB_BUSY_TIMEOUT секундами.
+    :param path: путь к файлу базы данных
+    :return: база данных
+    """
+    return peewee.SqliteDatabase(path, pragmas=db_pragmas(), timeout=bot_settings.DB_BUSY_TIMEOUT)
+
+
+db = make_database(bot_settings.DB_PATH)
+city_cache = TTLCache('city', bot_settings.CITY_CACHE_SIZE, bot_settings.CITY_CACHE_TTL,
+                      SqliteCacheTier(db, 'citycache') if bot_settings.CITY_CACHE_PERSIST else None)
+hotels_cache = TTLCache('hotels', bot_settings.HOTELS_CACHE_SIZE, bot_settings.HOTELS_CACHE_TTL,
+                        max_bytes=bot_settings.HOTELS_CACHE_BYTES, stale_ttl=bot_settings.HOTELS_CACHE_STALE_TTL)
+
+
+class StaticKeyboard(types.InlineKeyboardMarkup):
+
+    """
+    Inline-клавиатура, которая строится один раз и отправляется многократно.
+    Представление в формате json вычисляется при первой отправке и запоминается,
+    поэтому после первой отправки клавиатуру изменять нельзя.
+    """
+
+    def __init__(self, keyboard: List[List[types.InlineKeyboardButton]], row_width: int = 3):
+        """
+        первичная инициализация класса
+        :param keyboard: ряды кнопок
+        :param row_width: количество кнопок в ряду
+        """
+        super().__init__(row_width=row_width)
+        self.keyboard = keyboard
+        self._json: Optional[str] = None
+
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = super().to_json()
+        return self._json
 
 
 class BotKeyboard:
@@ -18,7 +80,7 @@ class BotKeyboard:
         """
         первичная инициализация класса
         :param keys: список, содержащий названия и возвращаемые значения кнопок
-        :param rows: количество столбцов в клавиатуре. пока не работает
+        :param rows: количество столбцов в клавиатуре
         """
         self.keys: List = keys
         self.rows: int = rows
@@ -56,114 +118,207 @@ class BotKeyboard:
         """
         self._rows = rows
 
-    def create_keys(self) -> types.InlineKeyboardMarkup:
+    def create_keys(self, static: bool = False) -> types.InlineKeyboardMarkup:
         """
-        Создает и возвращает inline-клавиатуру
+        Создает и возвращает inline-клавиатуру. Кнопки располагаются по rows в ряд.
+        :param static: создать StaticKeyboard для многократной отправки
         :return:собственно, клавиатура
         """
+        self.key_list = [types.InlineKeyboardButton(one_key[0], callback_data=one_key[1]) for one_key in self.keys]
         bot_keyboard = types.InlineKeyboardMarkup(row_width=self.rows)
-        for one_key in self.keys:
-            self.key_list.append(types.InlineKeyboardButton(one_key[0], callback_data=one_key[1]))
-        for all_keys in self.key_list:
-            bot_keyboard.add(all_keys)
+        bot_keyboard.add(*self.key_list)
+        if static:
+            return StaticKeyboard(bot_keyboard.keyboard, self.rows)
         return bot_keyboard
 
 
-class ThisHotel:
+class HotelRecord(NamedTuple):
 
     """
-    Класс, предоставляющий информацию по выбранному отелю
+    Краткая информация об отеле из результатов поиска.
+    В истории запросов хранится в виде списка значений, текст кнопки строится только при выводе клавиатуры.
     """
 
-    def __init__(self, all_data: Dict):
-        self.data_dict: Dict = all_data
+    id: str
+    name: str
+    stars: float
+    address: str
+    price: float
+    distance_km: float
+    lat: Optional[float]
+    lon: Optional[float]
+
+    @classmethod
+    def from_api(cls, one_hotel: Dict) -> 'HotelRecord':
+        """
+        Создает запись из одного элемента ответа properties/list
+        :param one_hotel: словарь с данными отеля
+        :return: запись об отеле
+        """
+        distance, _, unit = one_hotel.get('landmarks')[0].get('distance').partition(' ')
+        distance_km = float(distance.replace(',', '.'))
+        if unit.startswith('mile'):
+            distance_km = round(distance_km * 1.609, 2)
+        coordinate: Dict = one_hotel.get('coordinate', {})
+        return cls(id=str(one_hotel.get('id')), name=one_hotel.get('name'),
+                   stars=float(one_hotel.get('starRating', 0)),
+                   address=one_hotel.get('address').get('streetAddress'),
+                   price=one_hotel.get('ratePlan').get('price').get('exactCurrent'),
+                   distance_km=distance_km, lat=coordinate.get('lat'), lon=coordinate.get('lon'))
+
+    def button(self) -> Tuple[str, str]:
+        """
+        Возвращает название и возвращаемое значение кнопки inline-клавиатуры
+        :return: кортеж для BotKeyboard
+        """
+        return (f"{self.name}\n{'⭐️' * int(self.stars)}\n {self.address}. \n"
+                f"{self.price} руб.\n{self.distance_km} км до центра", self.id + '.hot')
+
+    @staticmethod
+    def dump(hotels: List['HotelRecord']) -> str:
+        """
+        Сериализует список записей для сохранения в историю запросов
+        :param hotels: список записей об отелях без повторяющихся id (повторы отбрасывает collect_pages)
+        :return: строка json, объект с записями, упорядоченными как в результатах поиска
+        """
+        return json.dumps({one_hotel.id: one_hotel[1:] for one_hotel in hotels}, ensure_ascii=False)
+
+    @classmethod
+    def from_button(cls, text: str, callback: str) -> Optional['HotelRecord']:
+        """
+        Восстанавливает запись из кнопки, сохраненной в истории предыдущими версиями бота.
+        Текст кнопки состоит из строк: название, звезды, адрес, цена в рублях, расстояние и подпись "до центра".
+        :param text: текст кнопки
+        :param callback: возвращаемое значение кнопки, id отеля с суффиксом .hot
+        :return: запись об отеле или None, если текст кнопки не удалось разобрать
+        """
+        lines = text.split('\n')
+        if len(lines) < 6:
+            return None
+        try:
+            return cls(id=callback.split(sep='.')[0], name='\n'.join(lines[:-5]), stars=float(lines[-5].count('⭐️')),
+                       address=lines[-4].strip().rstrip('.'), price=float(lines[-3].split(sep=' руб.')[0]),
+                       distance_km=float(lines[-2].strip().replace(',', '.')), lat=None, lon=None)
+        except ValueError:
+            return None
+
+    @classmethod
+    def load(cls, hotels: str) -> Dict[str, 'HotelRecord']:
+        """
+        Восстанавливает записи из истории запросов
+        Истории, сохраненные предыдущими версиями бота в виде готовых кнопок, разбираются в записи;
+        кнопки, которые не удалось разобрать, пропускаются.
+        :param hotels: строка json
+        :return: словарь записей по id отеля в порядке результатов поиска
+        """
+        data = json.loads(hotels)
+        if isinstance(data, list):
+            records = {}
+            for text, callback in data:
+                record = cls.from_button(text, callback)
+                if record is None:
+                    logger.warning('Не удалось разобрать отель из истории: {}', callback)
+                    continue
+                records[record.id] = record
+            return records
+        return {hotel_id: cls(hotel_id, *fields) for hotel_id, fields in data.items()}
+
+
+hotel_catalog = HotelCatalog(HotelRecord, bot_settings.CATALOG_TTL, bot_settings.CATALOG_MAX_SLICES)
+
+
+def catalog_key(querystring: Dict) -> Tuple:
+    """
+    Возвращает ключ набора каталога для запроса properties/list: направление и условия, от которых зависят цены
+    :param querystring: словарь, содержащий переменные, участвующие в запросе
+    :return: кортеж destinationId, дат, количества гостей, валюты и языка
+    """
+    return tuple(querystring[name]
+                 for name in ('destinationId', 'checkIn', 'checkOut', 'adults1', 'currency', 'locale'))
 
-    @property
-    def data_dict(self) -> Dict:
-        return self._data_dict
 
-    @data_dict.setter
-    def data_dict(self, all_data: Dict) -> None:
+class ThisHotel:
+
+    """
+    Класс, предоставляющий информацию по выбранному отелю.
+    Из ответа properties/get-details за один проход извлекаются только выводимые поля,
+    сам ответ в экземпляре не хранится.
+    """
+
+    __slots__ = ('name', 'latitude', 'longitude', 'overview', 'around', 'address', 'price')
+
+    def __init__(self, all_data: Dict):
         """
-        Инициализирует переменную, содержащую список всех данных отеля
+        первичная инициализация класса
         :param all_data: все данные об отеле в виде словаря
         """
-        self._data_dict: Dict = all_data
+        body: Dict = all_data.get('data').get('body')
+        description: Dict = body.get('propertyDescription')
+        coordinates: Dict = body.get('pdpHeader').get('hotelLocation').get('coordinates')
+        sections: List[Dict] = body.get('overview').get('overviewSections')
+        self.name: str = description.get('name')
+        self.latitude: float = coordinates.get('latitude')
+        self.longitude: float = coordinates.get('longitude')
+        self.overview: List[str] = sections[0].get('content')
+        self.around: List[str] = sections[1].get('content')
+        self.address: str = description.get('address').get('fullAddress')
+        self.price: str = str(description.get('featuredPrice').get('currentPrice').get('plain'))
 
     def show_name(self) -> str:
         """
         Возвращает имя отеля
         :return: имя отеля
         """
-        return self.data_dict.get('data').get('body').get('propertyDescription').get('name')
+        return self.name
 
     def show_coordinates(self) -> List:
         """
         Возвращает координаты отеля
         :return: список, содержащий координаты отеля
         """
-        latitude = self.data_dict.get('data').get('body').get('pdpHeader')\
-            .get('hotelLocation').get('coordinates').get('latitude')
-        longitude = self.data_dict.get('data').get('body').get('pdpHeader')\
-            .get('hotelLocation').get('coordinates').get('longitude')
-        return [latitude, longitude]
+        return [self.latitude, self.longitude]
 
-    def show_overview(self) -> Dict:
+    def show_overview(self) -> List[str]:
         """
         Возвращает обзор отеля
-        :return: словарь, содержащий обзор отеля
+        :return: список строк обзора отеля
         """
-        this_overview = self.data_dict.get('data').get('body').get('overview').get('overviewSections')[0].get('content')
-        return this_overview
+        return self.overview
 
-    def show_around(self) -> Dict:
+    def show_around(self) -> List[str]:
         """
         Возвращает окружение отеля
-        :return: словарь, содержащий описание того, что рядом с отелем
+        :return: список строк с описанием того, что рядом с отелем
         """
-        this_around = self.data_dict.get('data').get('body').get('overview').get('overviewSections')[1].get('content')
-        return this_around
+        return self.around
 
     def show_address(self) -> str:
         """
         Возвращает адрес отеля
         :return: адрес отеля
         """
-        this_address = self.data_dict.get('data').get('body').get('propertyDescription').get('address').get('fullAddress')
-        return this_address
+        return self.address
 
     def show_price(self) -> str:
         """
         Возвращает стоимость суток проживания в отеле
         :return: стоимость
         """
-        this_price = str(self.data_dict.get('data').get('body').get('propertyDescription').get('featuredPrice')\
-            .get('currentPrice').get('plain'))
-        return this_price
+        return self.price
 
     def get_all_info(self) -> str:
         """
         Собирает и возвращает строку, содержащую все данные об отеле
         :return: суммарно все данные об отеле в одной строке, разделенной символами перевода строки.
         """
-        info_string: str = ''
-        coords = self.show_coordinates()
-        info_string += self.show_name()
-        info_string += '\n'
-        info_string += f'Координаты отеля: {coords[0]}, {coords[1]}\n\n'
-        info_string += 'Описание:\n'
-        info_string += '\n'.join(self.show_overview())
-        info_string += '\n'
-        info_string += '\n'
-        info_string += 'Что находится рядом с отелем:\n'
-        info_string += '\n'.join(self.show_around())
-        info_string += '\n'
-        info_string += 'Цена за одну ночь:\n'
-        info_string += self.show_price()
-        info_string += '\n'
-        info_string += 'Адрес отеля:\n'
-        info_string += self.show_address()
-        return info_string
+        overview = '\n'.join(self.overview)
+        around = '\n'.join(self.around)
+        return (f'{self.name}\n'
+                f'Координаты отеля: {self.latitude}, {self.longitude}\n\n'
+                f'Описание:\n{overview}\n\n'
+                f'Что находится рядом с отелем:\n{around}\n'
+                f'Цена за одну ночь:\n{self.price}\n'
+                f'Адрес отеля:\n{self.address}')
 
 
 class ApiQuest:
@@ -181,10 +336,10 @@ class ApiQuest:
         self.this_api = my_api
         self.this_query = args
         self._headers = {'x-rapidapi-key': self.this_api, 'x-rapidapi-host': "hotels4.p.rapidapi.com"}
-        self._city_url = "https://hotels4.p.rapidapi.com/locations/search"
-        self._hotels_url = "https://hotels4.p.rapidapi.com/properties/list"
-        self._one_hotel_url = "https://hotels4.p.rapidapi.com/properties/get-details"
-        self._hotel_pics_url = "https://hotels4.p.rapidapi.com/properties/get-hotel-photos"
+        self._city_url = bot_settings.API_BASE_URL + "/locations/search"
+        self._hotels_url = bot_settings.API_BASE_URL + "/properties/list"
+        self._one_hotel_url = bot_settings.API_BASE_URL + "/properties/get-details"
+        self._hotel_pics_url = bot_settings.API_BASE_URL + "/properties/get-hotel-photos"
 
     @property
     def this_api(self) -> str:
@@ -204,44 +359,72 @@ class ApiQuest:
 
     def get_response(self, one_url: str, query: Dict) -> Dict:
         """
-        Получает, сериализует и возвращает ответ от API
-        В случае ошибки при получении ответа, возвращает пустой словарь
+        Получает через общий пул соединений, сериализует и возвращает ответ от API.
+        Одинаковые одновременные запросы выполняются один раз, ответ общий для всех вызывающих.
+        В случае ошибки при получении ответа, возвращает пустой словарь.
+        Длительность запроса и ошибки записываются в метрики по адресу API.
         :param one_url: url, по которому производится запрос
         :param query: словарь, содержащий переменные, участвующие в запросе
         :return: Dict
         """
-        response = dict()
+        endpoint = bot_metrics.endpoint(one_url)
+        started = time.perf_counter()
         try:
-            logger.info(f'Посылаю запрос {query} на url {one_url}')
-            response = requests.request("GET", one_url, headers=self._headers, params=query)
-            logger.info(f'Получен ответ {response}')
-        except Exception:
+            logger.info('Посылаю запрос на url {}', one_url)
+            bot_logging.log_payload('DEBUG', 'Параметры запроса', query)
+            return bot_transport.get_json_shared(one_url, self._headers, query)
+        except (requests.RequestException, ValueError):
+            bot_metrics.api_errors.inc(endpoint=endpoint)
             logger.info('Произошла ошибка при обращении к API сайта')
-        return response.json()
+        finally:
+            bot_metrics.api_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+        return dict()
 
     def get_city(self) -> List[Tuple]:
         """
         Получает список id городов, имя которых совпадает с введенным пользователем
+        Результат запоминается в city_cache по паре (название города, язык). В ключе кэша название
+        приводится к нижнему регистру и лишние пробелы удаляются, в API передается введенный пользователем текст.
         В случае ошибки возвращает пустой список
         :return: список кортежей, содержащих имя города с географической привязкой и его id
         """
+        city_name = self.this_query[0]
+        cache_key = (' '.join(city_name.split()).lower(), self.this_query[1])
+        cities = city_cache.get(cache_key)
+        if cities is not None:
+            logger.info('Город {} найден в кэше', city_name)
+            return [tuple(one_city) for one_city in cities]
         try:
-            querystring = {'query': self.this_query[0], 'locale': self.this_query[1]}
+            querystring = {'query': city_name, 'locale': self.this_query[1]}
             found_city = self.get_response(self._city_url, querystring)
             cities = [(elem.get('caption'), elem.get('destinationId'))
                       for elem in found_city.get('suggestions', [])[0].get('entities')
-                      if elem.get('type') == 'CITY' and self.this_query[0].lower() in elem.get('name').lower()]
+                      if elem.get('type') == 'CITY' and city_name.lower() in elem.get('name').lower()]
         except IndexError:
             cities = []
             logger.warning('Получен неправильный ответ от сайта при запросе города.')
+        if cities:
+            city_cache.put(cache_key, cities)
         return cities
 
     @logger.catch
-    def get_hotels(self) -> List[Tuple]:
+    def get_hotels(self) -> List[HotelRecord]:
         """
         Получает список отелей, подходящих под критерии, введенные пользователем.
+        Результаты поиска общие для всех чатов и запоминаются в hotels_cache по полному набору параметров запроса.
         В случае ошибки возвращает пустой список
-        :return: список кортежей, содержащих информацию об отелях
+        :return: список записей об отелях
+        """
+        return hotels_cache.get_or_load(tuple(self.this_query), self.load_hotels)
+
+    @logger.catch(default=[])
+    def load_hotels(self) -> List[HotelRecord]:
+        """
+        Запрашивает у API список отелей, подходящих под критерии, введенные пользователем.
+        Полученные отели добавляются в каталог hotel_catalog. Запрос /bestdeal к недавно просмотренному
+        направлению выполняется по каталогу без обращения к API.
+        В случае ошибки возвращает пустой список
+        :return: список записей об отелях
         """
         hotels_list = []
         try:
@@ -250,43 +433,82 @@ class ApiQuest:
                            "checkOut": self.this_query[4], "checkIn": self.this_query[5], "sortOrder": self.this_query[6],
                            "locale": self.this_query[7], "currency": self.this_query[8]}
             if self.this_query[6] != 'DISTANCE_FROM_LANDMARK':
-                logger.info(f'Команда {self.this_query[6]} в классе поиска отелей')
+                logger.info('Команда {} в классе поиска отелей', self.this_query[6])
                 found_hotels = self.get_response(self._hotels_url, querystring)
-                hotels_list = [(f"{one_hotel.get('name')}\n{'⭐️' * int(one_hotel.get('starRating', 0))}\n "
-                                f"{one_hotel.get('address').get('streetAddress')}. \n"
-                                f"{str(one_hotel.get('ratePlan').get('price').get('exactCurrent'))} руб.\n"
-                                f"{one_hotel.get('landmarks')[0].get('distance').split(sep=' ')[0]} \n до центра",
-                                str(one_hotel.get('id')) + '.hot')
+                hotels_list = [HotelRecord.from_api(one_hotel)
                                for one_hotel in found_hotels['data']['body']['searchResults']['results']]
+                hotel_catalog.add(catalog_key(querystring), hotels_list)
             else:
-                logger.info(f'Команда {self.this_query[6]} в классе поиска отелей, раздел bestdeal')
-                if self.this_query[7] == 'en_US':
-                    distance = round(float(self.this_query[10]) * 0.62, 2)
-                else:
-                    distance = float(self.this_query[10])
+                logger.info('Команда {} в классе поиска отелей, раздел bestdeal', self.this_query[6])
                 querystring["priceMax"] = self.this_query[9]
                 querystring["priceMin"] = '100'
-                while len(hotels_list) < int(self.this_query[3]):
-                    found_hotels: Dict = self.get_response(self._hotels_url, querystring)
-                    next_page: str = found_hotels.get('data').get('body').get('searchResults').get(
-                        'pagination').get("nextPageNumber")
-                    if not next_page or int(next_page) <= int(querystring['pageNumber']):
-                        break
-                    logger.info(f'Номер следующей страницы: {next_page}')
-                    querystring['pageNumber'] = next_page
-                    hotels_list.extend([(f"{one_hotel.get('name')}\n{'⭐️' * int(one_hotel.get('starRating', 0))}\n "
-                                         f"{one_hotel.get('address').get('streetAddress')}. \n"
-                                         f"{str(one_hotel.get('ratePlan').get('price').get('exactCurrent'))} руб. \n"
-                                         f"{one_hotel.get('landmarks')[0].get('distance').split(sep=' ')[0]} \n до центра",
-                                         str(one_hotel.get('id')) + '.hot')
-                                        for one_hotel in found_hotels['data']['body']['searchResults']['results']
-                                        if float(one_hotel.get('landmarks')[0].get(
-                            'distance').split(sep=' ')[0].replace(',', '.')) <= distance])
+                hotels_list = hotel_catalog.find(catalog_key(querystring), float(querystring["priceMin"]),
+                                                 float(querystring["priceMax"]), float(self.this_query[10]),
+                                                 int(self.this_query[3]))
+                if hotels_list is None:
+                    hotels_list = self.collect_pages(querystring, float(self.this_query[10]),
+                                                     int(self.this_query[3]))
+                else:
+                    logger.info('Отели найдены в каталоге направления {}', querystring["destinationId"])
         except IndexError as err:
             logger.warning('Получен неправильный ответ от сайта при запросе отелей.')
             logger.warning(err)
         return hotels_list
 
+    def collect_pages(self, querystring: Dict, distance: float, hot_num: int) -> List[HotelRecord]:
+        """
+        Участвует только в цепочке /bestdeal
+        Обходит страницы результатов поиска, пока не наберется hot_num отелей, удаленных от центра
+        не более чем на distance километров. Следующие BESTDEAL_PREFETCH_PAGES страниц запрашиваются заранее
+        и параллельно, но обрабатываются строго по порядку, поэтому результат не зависит от порядка получения ответов.
+        Все полученные отели добавляются в каталог, вместе с расстоянием, до которого просмотрены результаты.
+        Отель, повторно попавший на следующую страницу при сдвиге результатов, в список не добавляется.
+        :param querystring: словарь, содержащий переменные, участвующие в запросе
+        :param distance: максимальное расстояние до центра города в километрах
+        :param hot_num: необходимое количество отелей
+        :return: список записей об отелях
+        """
+        hotels_list: List[HotelRecord] = []
+        seen: set = set()
+        key = catalog_key(querystring)
+        started = time.time()
+        covered_km = -1.0
+        executor = bot_transport.get_executor('pages')
+        first_page = int(querystring['pageNumber'])
+        stop_page = first_page + bot_settings.BESTDEAL_MAX_PAGES
+        last_page: Optional[int] = None
+        pending: Dict[int, Future] = {}
+        page = first_page
+        try:
+            while len(hotels_list) < hot_num and page < stop_page and (last_page is None or page <= last_page):
+                for one_page in range(page, min(page + bot_settings.BESTDEAL_PREFETCH_PAGES + 1, stop_page)):
+                    if one_page not in pending and (last_page is None or one_page <= last_page):
+                        pending[one_page] = executor.submit(self.get_response, self._hotels_url,
+                                                            dict(querystring, pageNumber=str(one_page)))
+                found_hotels: Dict = pending.pop(page).result()
+                search_results: Dict = found_hotels.get('data', {}).get('body', {}).get('searchResults', {})
+                page_hotels = [HotelRecord.from_api(one_hotel) for one_hotel in search_results.get('results', [])]
+                hotel_catalog.add(key, page_hotels)
+                covered_km = max([covered_km] + [one_hotel.distance_km for one_hotel in page_hotels])
+                for one_hotel in page_hotels:
+                    if one_hotel.distance_km <= distance and one_hotel.id not in seen:
+                        seen.add(one_hotel.id)
+                        hotels_list.append(one_hotel)
+                next_page = search_results.get('pagination', {}).get('nextPageNumber')
+                if not next_page or int(next_page) <= page:
+                    last_page = page
+                else:
+                    logger.info('Номер следующей страницы: {}', next_page)
+                page += 1
+            if first_page == 1:
+                complete = last_page is not None and page > last_page
+                hotel_catalog.scanned(key, float(querystring['priceMax']), math.inf if complete else covered_km,
+                                      started)
+        finally:
+            for one_future in pending.values():
+                one_future.cancel()
+        return hotels_list[:hot_num]
+
     def get_one_hotel(self) -> str:
         """
         Получает от API и возвращает информацию об одном отеле. Использует для этого
@@ -299,14 +521,15 @@ class ApiQuest:
                                          "currency": self._this_query[4], "locale": self._this_query[5]}
             this_hotel = self.get_response(self._one_hotel_url, querystring)
             if this_hotel.get('result') != 'OK':
-                hotel_info = 'Произошла ошибка при обращении к сайту.'
+                hotel_info = SITE_ERROR
             else:
                 our_hotel = ThisHotel(this_hotel)
+                del this_hotel
                 hotel_info = our_hotel.get_all_info()
         except IndexError:
-            hotel_info = 'Запрос составлен неверно, обратитесь к администратору.'
+            hotel_info = QUERY_ERROR
             logger.warning('Получен неправильный ответ от сайта при запросе конкретного отеля.')
-            logger.warning(f'ID отеля: {self._this_query[0]}')
+            logger.warning('ID отеля: {}', self._this_query[0])
         return hotel_info
 
     def get_hotel_pics(self) -> List[str]:
@@ -324,7 +547,7 @@ class ApiQuest:
                     pics.append(one_pic.get("baseUrl"))
             return pics
         except IndexError:
-            logger.warning(f'Произошла ошибка при получении изображений отеля с id {self._this_query[0]}')
+            logger.warning('Произошла ошибка при получении изображений отеля с id {}', self._this_query[0])
             return pics
 
 
@@ -338,27 +561,73 @@ class MainModel(peewee.Model):
         database = db
 
 
+class EnumField(peewee.SmallIntegerField):
+    """
+    Поле, хранящее строковое значение из заранее известного набора в виде небольшого целого числа
+    """
+
+    def __init__(self, values: Tuple[str, ...], *args, **kwargs):
+        """
+        первичная инициализация класса
+        :param values: допустимые значения поля, в базе данных хранится индекс значения
+        """
+        self.values: Tuple[str, ...] = values
+        super().__init__(*args, **kwargs)
+
+    def db_value(self, value: Optional[str]) -> Optional[int]:
+        return None if value is None else self.values.index(value)
+
+    def python_value(self, value: Optional[int]) -> Optional[str]:
+        return None if value is None else self.values[value]
+
+
 class Session(MainModel):
     """
-    Класс, определяющий таблицу запросов пользователя newsessions и методы работы с ней
+    Класс, определяющий таблицу запросов пользователя sessions и методы работы с ней
     """
-    chat_id = peewee.CharField()
-    state = peewee.CharField()
-    lang = peewee.CharField()
-    city = peewee.CharField()
-    location = peewee.CharField()
-    hot_num = peewee.CharField()
-    persons = peewee.CharField()
-    check_in = peewee.CharField()
-    check_out = peewee.CharField()
-    currency = peewee.CharField()
-    start_price = peewee.CharField()
-    stop_price = peewee.CharField()
+    chat_id = peewee.BigIntegerField()
+    state = EnumField(('low', 'high', 'best'))
+    lang = EnumField(('ru_RU', 'en_US'), null=True)
+    city = peewee.CharField(null=True)
+    location = peewee.CharField(null=True)
+    hot_num = peewee.SmallIntegerField(null=True)
+    persons = peewee.SmallIntegerField(null=True)
+    check_in = peewee.DateField(null=True)
+    check_out = peewee.DateField(null=True)
+    currency = peewee.CharField(max_length=3, null=True)
+    start_price = peewee.DecimalField(max_digits=10, decimal_places=2, null=True)
+    stop_price = peewee.DecimalField(max_digits=10, decimal_places=2, null=True)
     t_stamp = peewee.FloatField()
-    distance = peewee.CharField()
+    distance = peewee.DecimalField(max_digits=7, decimal_places=2, null=True)
 
     class Meta:
-        db_table = 'newsessions'
+        db_table = 'sessions'
+        indexes = ((('chat_id', 't_stamp'), False),)
+
+    @classmethod
+    def coerce(cls, field: str, value: Any) -> Any:
+        """
+        Приводит значение, полученное от пользователя или из журнала, к типу поля таблицы.
+        Пустая строка считается отсутствующим значением. Если привести значение нельзя, вызывает ValueError.
+        :param field: название поля
+        :param value: значение
+        :return: значение типа поля
+        """
+        if value is None or value == '':
+            return None
+        this_field = cls._meta.fields[field]
+        if isinstance(this_field, EnumField):
+            if value not in this_field.values:
+                raise ValueError(f'Недопустимое значение {value} поля {field}')
+            return value
+        try:
+            result = this_field.python_value(value)
+        except ArithmeticError:
+            raise ValueError(f'Недопустимое значение {value} поля {field}')
+        if isinstance(this_field, peewee.IntegerField) and not isinstance(result, int) or \
+                isinstance(this_field, peewee.DateField) and not isinstance(result, datetime.date):
+            raise ValueError(f'Недопустимое значение {value} поля {field}')
+        return result
 
 
 class History(MainModel):
@@ -371,5 +640,32 @@ class History(MainModel):
 
     class Meta:
         db_table = 'newhistory'
+        indexes = ((('chat_id', 't_stamp'), False),)
+
+
+class HistoryArchive(MainModel):
+    """
+    Класс, определяющий архивную таблицу истории запросов.
+    Сюда переносятся старые записи newhistory, список отелей хранится сжатым zlib.
+    """
+    chat_id = peewee.CharField()
+    hotels = peewee.BlobField()
+    t_stamp = peewee.FloatField()
+
+    class Meta:
+        db_table = 'historyarchive'
+        indexes = ((('chat_id', 't_stamp'), False),)
+
 
+class NextStep(MainModel):
+    """
+    Класс, определяющий таблицу назначенных шагов цепочки опроса пользователя.
+    Для каждого чата хранится имя функции-шага и ее аргументы в формате json.
+    """
+    chat_id = peewee.BigIntegerField(primary_key=True)
+    step = peewee.CharField()
+    args = peewee.TextField()
+    t_stamp = peewee.FloatField()
 
+    class Meta:
+        db_table = 'nextsteps'
@@ -0,0 +1,19 @@
+import os
+import telebot
+from dotenv import load_dotenv
+import bot_outbox
+import bot_settings
+import bot_scheduler
+from bot_scheduler import ChatScheduler
+
+load_dotenv()
+my_token = os.getenv('BOT_TOKEN')
+my_rapi = os.getenv('RAPI_TOKEN')
+
+# Единственный экземпляр бота процесса. Вынесен из main.py: при запуске python main.py модуль main
+# загружается как __main__, и импорт из него в bots_funcs создал бы второй бот со своими пулом потоков
+# и очередью отправки
+bot = telebot.TeleBot(my_token)
+bot_scheduler.install(bot, ChatScheduler(bot_settings.HANDLER_WORKERS, bot_settings.CHAT_QUEUE_LIMIT,
+                                         bot_settings.HANDLER_MAX_TASKS, bot_settings.HANDLER_PUT_TIMEOUT))
+bot_outbox.install(bot)
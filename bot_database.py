@@ -1,57 +1,148 @@
+import threading
 import peewee
-from bot_classes import Session, History
+from bot_classes import db, MainModel, Session, History, HistoryArchive, NextStep
+from bot_state import session_store, save_session, SESSION_FIELDS
+import bot_logging
+import bot_metrics
 from loguru import logger
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Type
+
+
+MODELS: Dict[str, Type[MainModel]] = {'Session': Session, 'History': History, 'HistoryArchive': HistoryArchive,
+                                      'NextStep': NextStep}
+
+
+def get_model(one_model: str) -> Type[MainModel]:
+    """
+    Возвращает класс таблицы по его названию из реестра MODELS
+    :param one_model: название класса
+    :return: класс таблицы
+    """
+    try:
+        return MODELS[one_model]
+    except KeyError:
+        raise ValueError(f'Неизвестная таблица {one_model}')
 
 
 @logger.catch
 def create_tables(one_model: str) -> None:
     """
-    Если отсутствует таблица, создает ее в базе данных
+    Если отсутствует таблица, создает ее в базе данных.
+    Для существующей таблицы добавляет недостающие индексы.
     :param one_model: название класса, для использования внутри функции
     """
-    logger.info(f'Попытка создания таблицы {one_model}')
-    if not eval(one_model).table_exists():
-        eval(one_model).create_table()
+    logger.info('Попытка создания таблицы {}', one_model)
+    model = get_model(one_model)
+    if not model.table_exists():
+        model.create_table()
         logger.info('Таблица создана')
     else:
         logger.info('Таблица существует')
+        migrate_indexes(model)
+
+
+def migrate_indexes(model: Type[MainModel]) -> None:
+    """
+    Добавляет в существующую таблицу индексы, описанные в классе таблицы, если их еще нет
+    :param model: класс таблицы
+    """
+    model._schema.create_indexes(safe=True)
+    logger.info('Индексы таблицы {} проверены', model._meta.table_name)
+
+
+@logger.catch
+def migrate_sessions(legacy_table: str = 'newsessions', batch_size: int = 500) -> None:
+    """
+    Переносит записи из старой таблицы сессий, где все поля хранились строками, в таблицу Session
+    с типизированными полями. Перенос выполняется порциями в отдельных транзакциях, поэтому бот
+    может работать во время миграции: при запуске бота она выполняется в фоновом потоке
+    (start_session_migration). Повторный перенос записи безопасен, поэтому прерванная миграция
+    продолжается при следующем запуске.
+    После переноса старая таблица переименовывается.
+    :param legacy_table: имя старой таблицы
+    :param batch_size: количество записей в одной порции
+    """
+    if not db.table_exists(legacy_table):
+        return
+    logger.info('Перенос сессий из таблицы {}', legacy_table)
+    columns = ', '.join(SESSION_FIELDS)
+    last_id = 0
+    moved = 0
+    while True:
+        rows = db.execute_sql(f'SELECT id, {columns} FROM {legacy_table} WHERE id > ? ORDER BY id LIMIT ?',
+                              (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        with db.atomic():
+            for row in rows:
+                record = {}
+                for field, value in zip(SESSION_FIELDS, row[1:]):
+                    try:
+                        record[field] = Session.coerce(field, value)
+                    except ValueError:
+                        record[field] = None
+                if record['state'] is not None:
+                    save_session(record)
+                    moved += 1
+        last_id = rows[-1][0]
+    db.execute_sql(f'ALTER TABLE {legacy_table} RENAME TO {legacy_table}_migrated')
+    logger.info('Перенесено сессий: {}', moved)
+
+
+def start_session_migration() -> threading.Thread:
+    """
+    Запускает перенос сессий из старой таблицы в фоновом потоке, не задерживая получение обновлений
+    :return: поток миграции
+    """
+    thread = threading.Thread(target=migrate_sessions, name='session-migration', daemon=True)
+    thread.start()
+    return thread
 
 
 @logger.catch
 def update_record(one_field: str, one_value: str, this_chat_id: int):
     """
-    Обновляет значение поля в записи таблицы
+    Обновляет значение поля в последней сессии чата.
+    Изменение сохраняется в памяти и журнале, в таблицу Session оно записывается фоновым потоком.
     :param one_field: название поля, которое надо модифиуцировать
     :param one_value: значение модифицируемого поля
     :param this_chat_id: id чата, в котором происходит взаимодействие с ботом
     :return:
     """
-    query = eval(f"""Session.update({one_field}='{one_value}').where(
-        (Session.chat_id == this_chat_id) &
-        (Session.t_stamp == Session.select(peewee.fn.MAX(Session.t_stamp)).where(
-        Session.chat_id == this_chat_id).scalar()))""")
-    logger.info('Сохраняю изменения в базу')
-    query.execute()
+    session_store.update(this_chat_id, one_field, one_value)
 
 
 @logger.catch
 def select_some(chat_id: int, one_model: str, *args: Any) -> List[Any]:
     """
-    Производит выборку из таблицы базы данных
+    Производит выборку из последней записи чата. Сессии читаются из памяти,
+    остальные таблицы - из базы данных.
     :param chat_id: id чата, в котором происходит взаимодействие с ботом
     :param one_model: название класса, для использования внутри функции
     :param args: название полей, по которым нужно выполнить выборку из базы данных
     :return: результат запроса в виде списка
     """
-    this_record = eval(one_model).select().dicts().where((
-            (eval(one_model).chat_id == chat_id) &
-            (eval(one_model).t_stamp == eval(one_model).select(peewee.fn.MAX(eval(one_model).t_stamp)).where(
-                eval(one_model).chat_id == chat_id).scalar()))).get()
-    result = [this_record.get(field) for field in args]
-    return result
+    if one_model == 'Session':
+        return session_store.select(chat_id, *args)
+    return select_latest(get_model(one_model), chat_id, *args)
+
+
+@bot_metrics.db_operation
+def select_latest(model: Type[MainModel], chat_id: int, *args: Any) -> List[Any]:
+    """
+    Производит выборку из последней записи чата в таблице базы данных
+    :param model: класс таблицы
+    :param chat_id: id чата, в котором происходит взаимодействие с ботом
+    :param args: название полей, по которым нужно выполнить выборку из базы данных
+    :return: результат запроса в виде списка
+    """
+    fields = [model._meta.fields[field] for field in args]
+    this_record = model.select(*fields).where(model.chat_id == str(chat_id))\
+        .order_by(model.t_stamp.desc()).limit(1).tuples().get()
+    return list(this_record)
 
 
+@bot_metrics.db_operation
 def select_history(chat_id: int, tm_stamp: float, *args: Any) -> List[Any]:
     """
     Возвращает результат последнего запроса пользователя
@@ -60,34 +151,34 @@ def select_history(chat_id: int, tm_stamp: float, *args: Any) -> List[Any]:
     :param args: название полей, по которым нужно выполнить выборку из базы данных
     :return: Результат запроса в виде списка
     """
-    logger.info(type(tm_stamp))
-    logger.info(tm_stamp)
-    this_record = Session.select().dicts().where(Session.t_stamp == tm_stamp).get()
-    logger.info(this_record)
-    result = [this_record.get(field) for field in args]
-    return result
+    this_session = session_store.find(chat_id, tm_stamp)
+    if this_session is not None:
+        return [this_session.get(field) for field in args]
+    fields = [Session._meta.fields[field] for field in args]
+    this_record = Session.select(*fields).where(
+        (Session.chat_id == str(chat_id)) & (Session.t_stamp == tm_stamp)).tuples().get()
+    bot_logging.log_payload('DEBUG', 'Прочитана запись сессии', this_record)
+    return list(this_record)
 
 
 @logger.catch
 def create_record(chat_id: int, state: str, tm_stamp: float) -> None:
     """
-    Добавляет в таблицу Sessions новую запись
+    Начинает новую сессию чата. Запись в таблицу Session выполняется фоновым потоком.
     :param chat_id: id чата
     :param state: тип цепочки (low, high, best)
     :param tm_stamp: таймстамп, содержит время ввода пользователем команды, после которой начинается цепочка
     """
-    this_session = Session(chat_id=chat_id, state=state, lang='', city='', location='', hot_num='',
-                           persons='', check_in='', check_out='', currency='', start_price='',
-                           stop_price='', t_stamp=tm_stamp, distance='')
     try:
-        this_session.save()
-        logger.info(f'Начало сессии с chat_id = {chat_id}, получена команда {state}')
+        session_store.create(chat_id, state, tm_stamp)
+        logger.info('Начало сессии с chat_id = {}, получена команда {}', chat_id, state)
     except Exception as err:
-        logger.error(f'Произошла ошибка при добавлении записи сессии с chat_id = {chat_id}.')
+        logger.error('Произошла ошибка при добавлении записи сессии с chat_id = {}.', chat_id)
         logger.error(err)
 
 
 @logger.catch
+@bot_metrics.db_operation
 def create_history(chat_id: int, hotels: str, tm_stamp: float) -> None:
     """
     Добавляет запись в таблицу истории запросов пользователя
@@ -98,6 +189,6 @@ def create_history(chat_id: int, hotels: str, tm_stamp: float) -> None:
     this_session = History(chat_id=chat_id, hotels=hotels, t_stamp=tm_stamp)
     try:
         this_session.save()
-        logger.info(f'Сохранение результатов запроса chat_id = {chat_id}')
+        logger.info('Сохранение результатов запроса chat_id = {}', chat_id)
     except Exception:
-        logger.error(f'Произошла ошибка при сохранении результатов запроса с chat_id = {chat_id}.')
+        logger.error('Произошла ошибка при сохранении результатов запроса с chat_id = {}.', chat_id)
@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+import bot_settings
+from bot_classes import db, db_pragmas, Session, History
+from bot_state import SessionStore
+
+# Записи цепочки /bestdeal в порядке их выполнения обработчиками из bots_funcs
+CHAIN: List[Tuple[str, Any]] = [('lang', 'ru_RU'), ('city', 'Москва'), ('location', '1153093'), ('hot_num', '5'),
+                                ('distance', '3.5'), ('stop_price', '5000'), ('persons', '2'),
+                                ('check_in', '2022-05-01'), ('check_out', '2022-05-03')]
+
+# Сравниваемые варианты: параметры sqlite по умолчанию без группировки записей,
+# параметры из настроек без группировки и с группировкой
+VARIANTS: List[Tuple[str, Dict[str, Any], bool]] = [
+    ('sqlite по умолчанию, direct', {'journal_mode': 'delete', 'synchronous': 'full'}, False),
+    ('настройки DB_*, direct', db_pragmas(), False),
+    ('настройки DB_*, batch', db_pragmas(), True),
+]
+
+
+def run_chain(store: SessionStore, chat_id: int) -> None:
+    """
+    Повторяет обращения к базе данных одной цепочки опроса: начало сессии, сохранение ответов
+    пользователя, чтение даты заезда и сохранение результатов поиска в историю
+    :param store: хранилище сессий
+    :param chat_id: id чата
+    """
+    tm_stamp = time.time()
+    store.create(chat_id, 'best', tm_stamp)
+    for field, value in CHAIN:
+        if field == 'check_out':
+            store.select(chat_id, 'check_in')
+        store.update(chat_id, field, value)
+    History.insert(chat_id=chat_id, hotels='{}', t_stamp=tm_stamp).execute()
+
+
+def bench(pragmas: Dict[str, Any], batch: bool, chains: int, threads: int) -> float:
+    """
+    Выполняет chains цепочек в threads потоках на временной базе данных
+    :param pragmas: параметры sqlite
+    :param batch: группировать ли записи сессий в одну транзакцию
+    :param chains: количество цепочек
+    :param threads: количество потоков
+    :return: количество записей в базу в секунду
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        db.init(os.path.join(folder, 'bench.db'), pragmas=pragmas, timeout=bot_settings.DB_BUSY_TIMEOUT)
+        db.create_tables([Session, History])
+        store = SessionStore(os.path.join(folder, 'journal.log'), bot_settings.SESSION_FLUSH_INTERVAL,
+                             bot_settings.SESSION_IDLE_TTL, bot_settings.SESSION_JOURNAL_FSYNC, batch)
+        store.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda number: run_chain(store, number), range(chains)))
+        store.stop()
+        elapsed = time.perf_counter() - started
+        db.close()
+    return chains * (len(CHAIN) + 2) / elapsed
+
+
+if __name__ == '__main__':
+    chains = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else bot_settings.HANDLER_WORKERS
+    for name, pragmas, batch in VARIANTS:
+        print(f'{name}: {bench(pragmas, batch, chains, threads):.0f} записей в секунду')
@@ -0,0 +1,222 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional, TextIO
+from loguru import logger
+import bot_metrics
+import bot_settings
+
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """
+    Разбирает уровни логирования модулей из строки вида bots_funcs=WARNING,bot_cache=ERROR
+    :param levels: строка с уровнями
+    :return: словарь уровней по имени модуля
+    """
+    result: Dict[str, str] = {}
+    for pair in levels.split(','):
+        module, _, level = pair.partition('=')
+        if module.strip() and level.strip():
+            result[module.strip()] = level.strip().upper()
+    return result
+
+
+LEVELS: Dict[str, str] = dict(parse_levels(bot_settings.LOG_LEVELS), **{'': bot_settings.LOG_LEVEL.upper()})
+
+_payloads: Counter = Counter()
+_payloads_lock = threading.Lock()
+
+
+def module_level(module: str) -> int:
+    """
+    Возвращает минимальный уровень сообщений модуля. Как и в loguru, уровень пакета
+    действует на вложенные модули, если для них уровень не задан.
+    :param module: имя модуля
+    :return: номер уровня
+    """
+    while module not in LEVELS:
+        module = module.rpartition('.')[0]
+    return logger.level(LEVELS[module]).no
+
+
+def enabled(level: str, depth: int = 1) -> bool:
+    """
+    Проверяет, будет ли записано сообщение уровня level из модуля вызывающей функции
+    :param level: уровень сообщения
+    :param depth: глубина вызывающей функции в стеке относительно enabled
+    :return: True, если сообщение будет записано
+    """
+    module = sys._getframe(depth).f_globals.get('__name__', '')
+    return logger.level(level).no >= module_level(module)
+
+
+class Payload:
+
+    """
+    Обертка для больших объектов в сообщениях лога. Строка объекта строится только при записи
+    сообщения и обрезается до LOG_PAYLOAD_LIMIT символов.
+    """
+
+    __slots__ = ('obj', 'limit')
+
+    def __init__(self, obj: Any, limit: int = bot_settings.LOG_PAYLOAD_LIMIT):
+        """
+        первичная инициализация класса
+        :param obj: объект
+        :param limit: максимальная длина строки
+        """
+        self.obj = obj
+        self.limit: int = limit
+
+    def __str__(self) -> str:
+        text = self.obj if isinstance(self.obj, str) else repr(self.obj)
+        if len(text) <= self.limit:
+            return text
+        return f'{text[:self.limit]}... (всего {len(text)} символов)'
+
+    def __format__(self, format_spec: str) -> str:
+        return str(self)
+
+
+def log_payload(level: str, message: str, obj: Any) -> None:
+    """
+    Записывает в лог большой объект: только если уровень включен для модуля вызывающей функции,
+    только каждый LOG_PAYLOAD_SAMPLE-й раз для одного и того же сообщения и с обрезкой до LOG_PAYLOAD_LIMIT символов
+    :param level: уровень сообщения
+    :param message: текст сообщения
+    :param obj: объект
+    """
+    if not enabled(level, depth=2):
+        return
+    if bot_settings.LOG_PAYLOAD_SAMPLE > 1:
+        with _payloads_lock:
+            _payloads[message] += 1
+            if (_payloads[message] - 1) % bot_settings.LOG_PAYLOAD_SAMPLE:
+                return
+    logger.opt(depth=1).log(level, message + ': {}', Payload(obj))
+
+
+class QueueSink:
+
+    """
+    Приемник сообщений loguru с ограниченной очередью. Вызывающий поток только помещает готовую строку
+    в очередь, запись в файл и на экран выполняет отдельный поток. Если очередь заполнена,
+    сообщение отбрасывается, а количество отброшенных сообщений записывается в лог позже.
+    """
+
+    def __init__(self, file_name: str, rotation: int, maxsize: int, stderr: bool):
+        """
+        первичная инициализация класса
+        :param file_name: файл лога, пустая строка - не писать в файл
+        :param rotation: размер файла в байтах, после которого он переименовывается и начинается новый
+        :param maxsize: максимальная длина очереди
+        :param stderr: выводить ли сообщения на экран
+        """
+        self.file_name: str = file_name
+        self.rotation: int = rotation
+        self.stderr: bool = stderr
+        self.dropped: int = 0
+        self._reported: int = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._thread = threading.Thread(target=self._work, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, message: str) -> None:
+        """
+        Помещает сообщение в очередь, не ожидая записи
+        :param message: отформатированное сообщение
+        """
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _open(self) -> TextIO:
+        """
+        Открывает файл лога, при превышении размера переименовывает старый файл
+        :return: файл
+        """
+        if self._file is not None and self._file.tell() >= self.rotation:
+            self._file.close()
+            self._file = None
+            os.replace(self.file_name, f'{self.file_name}.{time.strftime("%Y-%m-%d_%H-%M-%S")}')
+        if self._file is None:
+            self._file = open(self.file_name, 'a', encoding='utf-8')
+        return self._file
+
+    def _work(self) -> None:
+        """
+        Цикл потока записи. Сообщения, накопившиеся в очереди, записываются одной пачкой.
+        Ошибка записи не останавливает поток: пачка отбрасывается, а flush не зависает.
+        """
+        while True:
+            lines = [self._queue.get()]
+            while True:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            received = len(lines)
+            with self._lock:
+                dropped = self.dropped
+            if dropped != self._reported:
+                lines.append(f'{time.strftime("%Y-%m-%d %H:%M:%S")} | WARNING  | bot_logging - '
+                             f'Очередь лога переполнена, отброшено сообщений: {dropped - self._reported}\n')
+                self._reported = dropped
+            try:
+                text = ''.join(lines)
+                if self.file_name:
+                    log_file = self._open()
+                    log_file.write(text)
+                    log_file.flush()
+                if self.stderr:
+                    sys.stderr.write(text)
+            except Exception:
+                pass
+            finally:
+                for _ in range(received):
+                    self._queue.task_done()
+
+    def flush(self) -> None:
+        """
+        Дожидается записи всех сообщений из очереди
+        """
+        self._queue.join()
+
+
+_sink: Optional[QueueSink] = None
+
+
+def setup(file_name: str = bot_settings.LOG_FILE) -> None:
+    """
+    Настраивает логирование: удаляет стандартный вывод loguru и добавляет приемник с ограниченной очередью.
+    Уровни задаются LOG_LEVEL и, для отдельных модулей, LOG_LEVELS.
+    :param file_name: файл лога
+    """
+    global _sink
+    if _sink is not None:
+        return
+    _sink = QueueSink(file_name, bot_settings.LOG_ROTATION, bot_settings.LOG_QUEUE_SIZE, bot_settings.LOG_STDERR)
+    logger.remove()
+    logger.add(_sink.write, level=min(logger.level(level).no for level in LEVELS.values()), filter=LEVELS,
+               format='{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {name}:{function}:{line} - {message}')
+    atexit.register(_sink.flush)
+
+
+def flush() -> None:
+    """
+    Дожидается записи всех сообщений, принятых приемником
+    """
+    if _sink is not None:
+        _sink.flush()
+
+
+bot_metrics.Collected('bot_log_dropped_total', 'Сообщения лога, отброшенные из-за переполнения очереди',
+                      'counter', (), lambda: {(): _sink.dropped if _sink is not None else 0})
@@ -0,0 +1,320 @@
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger
+import bot_settings
+
+BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metric:
+
+    """
+    Метрика с набором меток. Значения хранятся отдельно для каждого сочетания значений меток.
+    """
+
+    kind: str = 'untyped'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = ()):
+        """
+        первичная инициализация класса
+        :param name: имя метрики в формате Prometheus
+        :param description: описание метрики
+        :param labels: имена меток
+        """
+        self.name: str = name
+        self.description: str = description
+        self.labels: Tuple[str, ...] = labels
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        """
+        Возвращает значения меток в порядке их объявления
+        :param labels: значения меток
+        :return: кортеж значений
+        """
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _label_string(self, key: Tuple[str, ...], extra: str = '') -> str:
+        """
+        Формирует метки в формате Prometheus
+        :param key: значения меток
+        :param extra: дополнительная метка, например le для гистограмм
+        :return: строка вида {label="value"}
+        """
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> List[str]:
+        """
+        Возвращает строки со значениями метрики
+        :return: список строк
+        """
+        with self._lock:
+            return [f'{self.name}{self._label_string(key)} {value}' for key, value in self._values.items()]
+
+    def render(self) -> str:
+        """
+        Возвращает метрику в текстовом формате Prometheus
+        :return: описание, тип и значения метрики
+        """
+        return '\n'.join([f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}'] +
+                         self.samples())
+
+
+class Counter(Metric):
+
+    """
+    Счетчик, значение которого только увеличивается
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        """
+        Увеличивает счетчик
+        :param amount: величина увеличения
+        :param labels: значения меток
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+
+    """
+    Гистограмма длительностей в секундах
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = BUCKETS):
+        """
+        первичная инициализация класса
+        :param name: имя метрики
+        :param description: описание метрики
+        :param labels: имена меток
+        :param buckets: верхние границы интервалов гистограммы
+        """
+        super().__init__(name, description, labels)
+        self.buckets: Tuple[float, ...] = buckets
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """
+        Добавляет наблюдение в гистограмму
+        :param value: длительность в секундах
+        :param labels: значения меток
+        """
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for border, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if border == float('inf') else f'le="{border}"'
+                    lines.append(f'{self.name}_bucket{self._label_string(key, le)} {cumulative}')
+                lines.append(f'{self.name}_sum{self._label_string(key)} {total}')
+                lines.append(f'{self.name}_count{self._label_string(key)} {cumulative}')
+        return lines
+
+
+class Collected(Metric):
+
+    """
+    Метрика, значения которой при каждом выводе получаются вызовом функции,
+    например счетчики попаданий кэшей
+    """
+
+    def __init__(self, name: str, description: str, kind: str, labels: Tuple[str, ...],
+                 collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        """
+        первичная инициализация класса
+        :param name: имя метрики
+        :param description: описание метрики
+        :param kind: тип метрики: counter или gauge
+        :param labels: имена меток
+        :param collect: функция, возвращающая значения по кортежам значений меток
+        """
+        super().__init__(name, description, labels)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{self._label_string(key)} {value}' for key, value in self.collect().items()]
+
+
+METRICS: List[Metric] = []
+CACHES: List[Any] = []
+
+api_seconds = Histogram('bot_api_request_seconds', 'Длительность запросов к API hotels4', ('endpoint',))
+api_errors = Counter('bot_api_errors_total', 'Запросы к API hotels4, завершившиеся ошибкой', ('endpoint',))
+api_coalesced = Counter('bot_api_coalesced_total', 'Запросы к API, получившие ответ одинакового одновременного запроса',
+                        ('endpoint',))
+api_retries = Counter('bot_api_retries_total', 'Повторные запросы к API hotels4', ('endpoint', 'reason'))
+db_seconds = Histogram('bot_db_seconds', 'Длительность операций с базой данных', ('operation',))
+handler_seconds = Histogram('bot_handler_seconds', 'Длительность обработчиков сообщений', ('handler',))
+telegram_seconds = Histogram('bot_telegram_request_seconds', 'Длительность запросов к Telegram Bot API',
+                             ('method',))
+telegram_merged = Counter('bot_telegram_merged_total', 'Текстовые сообщения, объединенные с предыдущим сообщением чата')
+telegram_throttled = Counter('bot_telegram_throttled_total', 'Ответы Telegram 429 с требованием повторить запрос позже')
+
+
+def _cache_stats(field: str) -> Dict[Tuple[str, ...], float]:
+    """
+    Собирает одно из значений статистики всех кэшей
+    :param field: название значения в TTLCache.stats()
+    :return: значения по имени кэша
+    """
+    return {(cache.name,): cache.stats()[field] for cache in CACHES}
+
+
+Collected('bot_cache_hits_total', 'Попадания в кэш', 'counter', ('cache',), lambda: _cache_stats('hits'))
+Collected('bot_cache_stale_hits_total', 'Выдача устаревших записей кэша', 'counter', ('cache',),
+          lambda: _cache_stats('stale_hits'))
+Collected('bot_cache_misses_total', 'Промахи кэша', 'counter', ('cache',), lambda: _cache_stats('misses'))
+Collected('bot_cache_entries', 'Количество записей в кэше', 'gauge', ('cache',), lambda: _cache_stats('size'))
+
+
+def register_cache(cache: Any) -> None:
+    """
+    Добавляет кэш в метрики попаданий и промахов
+    :param cache: кэш с методом stats() и атрибутом name
+    """
+    CACHES.append(cache)
+
+
+def endpoint(url: str) -> str:
+    """
+    Возвращает имя адреса API для метки метрики, например properties/list
+    :param url: адрес запроса
+    :return: две последние части пути
+    """
+    return '/'.join(url.split('?')[0].rstrip('/').split('/')[-2:])
+
+
+def timed(histogram: Histogram, label: str) -> Callable:
+    """
+    Декоратор, записывающий длительность вызова функции в гистограмму.
+    Значением метки label становится имя функции.
+    :param histogram: гистограмма
+    :param label: имя метки
+    :return: декоратор
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **{label: func.__name__})
+        return wrapper
+    return decorator
+
+
+handler = timed(handler_seconds, 'handler')
+db_operation = timed(db_seconds, 'operation')
+
+
+def telegram_sender(method: str, url: str, **kwargs: Any) -> Any:
+    """
+    Отправляет запрос к Telegram Bot API через сессию telebot и записывает его длительность.
+    Устанавливается как apihelper.CUSTOM_REQUEST_SENDER.
+    :param method: http-метод
+    :param url: адрес запроса, последняя часть которого - метод Bot API
+    :param kwargs: параметры запроса requests
+    :return: ответ requests
+    """
+    from telebot import apihelper
+    started = time.perf_counter()
+    try:
+        return apihelper._get_req_session().request(method, url, **kwargs)
+    finally:
+        telegram_seconds.observe(time.perf_counter() - started, method=url.rsplit('/', 1)[-1])
+
+
+def render() -> str:
+    """
+    Возвращает все метрики в текстовом формате Prometheus
+    :return: текст для /metrics
+    """
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+
+def dump(file_name: str) -> None:
+    """
+    Записывает все метрики в файл. Файл заменяется целиком, поэтому читатель не увидит его частично записанным.
+    :param file_name: путь к файлу
+    """
+    with open(file_name + '.tmp', 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(render())
+    os.replace(file_name + '.tmp', file_name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def _dump_forever(file_name: str, interval: float) -> None:
+    """
+    Периодически записывает метрики в файл
+    :param file_name: путь к файлу
+    :param interval: период в секундах
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            dump(file_name)
+        except OSError as err:
+            logger.warning('Не удалось записать метрики в {}: {}', file_name, err)
+
+
+def start(shard: Optional[int] = None) -> None:
+    """
+    Включает запись длительности запросов к Telegram и запускает выдачу метрик:
+    http-сервер /metrics на порту METRICS_PORT и/или периодическую запись в файл METRICS_FILE.
+    Процесс с номером shard использует порт METRICS_PORT + 1 + shard и файл METRICS_FILE.shard.
+    :param shard: номер процесса при запуске через supervisor.py
+    """
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = telegram_sender
+    if bot_settings.METRICS_PORT:
+        port = bot_settings.METRICS_PORT if shard is None else bot_settings.METRICS_PORT + 1 + shard
+        server = ThreadingHTTPServer((bot_settings.METRICS_HOST, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info('Метрики доступны по адресу http://{}:{}/metrics', bot_settings.METRICS_HOST, port)
+    if bot_settings.METRICS_FILE:
+        file_name = bot_settings.METRICS_FILE if shard is None else f'{bot_settings.METRICS_FILE}.{shard}'
+        threading.Thread(target=_dump_forever, args=(file_name, bot_settings.METRICS_INTERVAL),
+                         name='metrics-dump', daemon=True).start()
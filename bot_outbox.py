@@ -0,0 +1,307 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Optional, Tuple
+from loguru import logger
+from telebot import apihelper, types
+import bot_metrics
+import bot_settings
+
+# Максимальная длина текста сообщения Telegram
+MESSAGE_LIMIT: int = 4096
+# Методы бота, вызовы которых ставятся в очередь отправки
+METHODS: Tuple[str, ...] = ('send_message', 'send_photo', 'send_media_group', 'edit_message_reply_markup')
+
+
+class TokenBucket:
+
+    """
+    Ограничитель частоты: rate отправок в секунду с запасом до capacity отправок подряд
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        первичная инициализация класса
+        :param rate: количество отправок в секунду
+        :param capacity: максимальное количество отправок подряд
+        """
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """
+        Возвращает время до следующей разрешенной отправки
+        :param now: текущее время time.monotonic()
+        :return: задержка в секундах, 0 - отправить можно сразу
+        """
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        """
+        Учитывает одну отправку. Вызывается после delay, вернувшего 0.
+        """
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        """
+        Проверяет, восстановился ли запас отправок полностью
+        :param now: текущее время time.monotonic()
+        :return: True, если ограничитель можно удалить без потери состояния
+        """
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Outbox:
+
+    """
+    Очередь исходящих запросов к Telegram. Обработчики только ставят запрос в очередь чата и сразу
+    продолжают работу, отправку выполняют потоки Outbox. Запросы одного чата отправляются по порядку,
+    с ограничением частоты для чата и для бота в целом. При ответе 429 запрос повторяется через
+    указанное Telegram время retry_after. Идущие подряд текстовые сообщения одного чата без
+    оформления объединяются в одно; клавиатура последнего из них переносится в объединенное сообщение.
+    """
+
+    def __init__(self, bot: Any, workers: int, global_rate: float, chat_rate: float, chat_burst: float,
+                 merge_delay: float):
+        """
+        первичная инициализация класса
+        :param bot: чат-бот; для отправки используются его исходные методы
+        :param workers: количество потоков отправки
+        :param global_rate: количество запросов в секунду для всего бота
+        :param chat_rate: количество запросов в секунду для одного чата
+        :param chat_burst: количество запросов одного чата, которые можно отправить подряд
+        :param merge_delay: сколько секунд ждать следующих сообщений чата перед отправкой первого
+        """
+        self._methods: Dict[str, Any] = {name: getattr(bot, name) for name in METHODS}
+        self.chat_rate: float = chat_rate
+        self.chat_burst: float = chat_burst
+        self.merge_delay: float = merge_delay
+        self.merged: int = 0
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+        self._chats: Dict[Hashable, Deque[Tuple[str, tuple, dict]]] = {}
+        self._ready: List[Tuple[float, int, Hashable]] = []
+        self._order = itertools.count()
+        self._closing: bool = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._workers: List[threading.Thread] = [
+            threading.Thread(target=self._work, name=f'outbox-{number}', daemon=True) for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, chat_id: Hashable, method: str, args: tuple, kwargs: dict) -> None:
+        """
+        Ставит запрос в очередь чата
+        :param chat_id: id чата
+        :param method: метод бота из METHODS
+        :param args: аргументы метода
+        :param kwargs: именованные аргументы метода
+        """
+        with self._lock:
+            requests = self._chats.get(chat_id)
+            if requests is None:
+                requests = self._chats[chat_id] = deque()
+                self._schedule(chat_id, time.monotonic() + self.merge_delay)
+            requests.append((method, args, kwargs))
+
+    def _schedule(self, chat_id: Hashable, when: float) -> None:
+        """
+        Помещает чат в очередь готовых к отправке. Вызывается под блокировкой.
+        :param chat_id: id чата
+        :param when: время time.monotonic(), раньше которого чат не обрабатывается
+        """
+        heapq.heappush(self._ready, (when, next(self._order), chat_id))
+        self._changed.notify()
+
+    def _bucket(self, chat_id: Hashable, now: float) -> TokenBucket:
+        """
+        Возвращает ограничитель частоты чата. Ограничители с полным запасом удаляются,
+        когда их становится слишком много.
+        :param chat_id: id чата
+        :param now: текущее время time.monotonic()
+        :return: ограничитель частоты
+        """
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= 10000:
+                self._buckets = {key: one_bucket for key, one_bucket in self._buckets.items()
+                                 if not one_bucket.full(now)}
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _merge(self, requests: Deque[Tuple[str, tuple, dict]]) -> Tuple[str, tuple, dict]:
+        """
+        Забирает из очереди чата следующий запрос, объединяя идущие подряд простые текстовые сообщения.
+        Вызывается под блокировкой.
+        :param requests: очередь чата
+        :return: запрос
+        """
+        method, args, kwargs = requests.popleft()
+        if method != 'send_message' or kwargs:
+            return method, args, kwargs
+        chat_id, text = args
+        while requests:
+            next_method, next_args, next_kwargs = requests[0]
+            if next_method != 'send_message' or set(next_kwargs) - {'reply_markup'} \
+                    or len(text) + 2 + len(next_args[1]) > MESSAGE_LIMIT:
+                break
+            requests.popleft()
+            text = f'{text}\n\n{next_args[1]}'
+            kwargs = next_kwargs
+            self.merged += 1
+            bot_metrics.telegram_merged.inc()
+            if kwargs:
+                break
+        return method, (chat_id, text), kwargs
+
+    def _next(self) -> Optional[Tuple[Hashable, Tuple[str, tuple, dict]]]:
+        """
+        Дожидается чата, для которого можно отправить запрос, и забирает запрос из его очереди
+        :return: id чата и запрос или None, если очередь закрыта и пуста
+        """
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    chat_id = heapq.heappop(self._ready)[2]
+                    bucket = self._bucket(chat_id, now)
+                    delay = max(bucket.delay(now), self._global.delay(now))
+                    if delay > 0:
+                        self._schedule(chat_id, now + delay)
+                        continue
+                    bucket.take()
+                    self._global.take()
+                    return chat_id, self._merge(self._chats[chat_id])
+                if self._closing and not self._chats:
+                    return None
+                self._changed.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _send(self, chat_id: Hashable, request: Tuple[str, tuple, dict]) -> float:
+        """
+        Выполняет запрос к Telegram
+        :param chat_id: id чата
+        :param request: метод, аргументы и именованные аргументы
+        :return: время в секундах, через которое запрос нужно повторить, 0 - повтор не нужен
+        """
+        method, args, kwargs = request
+        try:
+            self._methods[method](*args, **kwargs)
+        except apihelper.ApiTelegramException as err:
+            if err.error_code == 429:
+                retry_after = float(err.result_json.get('parameters', {}).get('retry_after', 1))
+                bot_metrics.telegram_throttled.inc()
+                logger.warning('Превышен лимит отправки в чат {}, повтор через {} с', chat_id, retry_after)
+                return retry_after
+            self._failed(chat_id, request, err)
+        except Exception as err:
+            self._failed(chat_id, request, err)
+        return 0.0
+
+    def _failed(self, chat_id: Hashable, request: Tuple[str, tuple, dict], err: Exception) -> None:
+        """
+        Обрабатывает ошибку запроса. Альбом, отклоненный Telegram, отправляется по одному изображению.
+        :param chat_id: id чата
+        :param request: метод, аргументы и именованные аргументы
+        :param err: ошибка
+        """
+        method, args, kwargs = request
+        logger.warning('Не удалось выполнить {} для чата {}: {}', method, chat_id, err)
+        if method == 'send_media_group':
+            with self._lock:
+                self._chats[chat_id].extendleft(
+                    reversed([('send_photo', (args[0], media.media), {}) for media in args[1]]))
+
+    def _work(self) -> None:
+        """
+        Цикл потока отправки. Пока запрос чата выполняется, чата нет в очереди готовых,
+        поэтому запросы одного чата не отправляются параллельно.
+        """
+        while True:
+            task = self._next()
+            if task is None:
+                break
+            chat_id, request = task
+            retry_after = self._send(chat_id, request)
+            with self._lock:
+                requests = self._chats[chat_id]
+                if retry_after:
+                    requests.appendleft(request)
+                    self._schedule(chat_id, time.monotonic() + retry_after)
+                elif requests:
+                    self._schedule(chat_id, time.monotonic())
+                else:
+                    del self._chats[chat_id]
+                    self._changed.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает количество чатов с неотправленными запросами, количество таких запросов
+        и количество объединенных сообщений
+        :return: словарь со статистикой
+        """
+        with self._lock:
+            return {'chats': len(self._chats), 'requests': sum(len(requests) for requests in self._chats.values()),
+                    'merged': self.merged}
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """
+        Отправляет уже поставленные запросы и останавливает потоки отправки
+        :param timeout: максимальное время ожидания в секундах
+        """
+        with self._lock:
+            self._closing = True
+            self._changed.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+
+def queued(outbox: Outbox, method: str) -> Any:
+    """
+    Создает замену метода бота, которая ставит запрос в очередь и сразу возвращает управление.
+    Вместо отправленного сообщения возвращается сообщение, в котором известен только чат:
+    обработчикам цепочки опроса нужен только его id.
+    :param outbox: очередь отправки
+    :param method: метод бота из METHODS
+    :return: функция с аргументами метода бота
+    """
+    def send(chat_id: Any, *args: Any, **kwargs: Any) -> types.Message:
+        outbox.put(chat_id, method, (chat_id, *args), kwargs)
+        return types.Message(0, None, int(time.time()), types.Chat(chat_id, 'private'), 'text', {}, '')
+
+    def send_message(chat_id: Any, text: str, **kwargs: Any) -> types.Message:
+        return send(chat_id, text, **kwargs)
+
+    return send_message if method == 'send_message' else send
+
+
+def install(bot: Any) -> Optional[Outbox]:
+    """
+    Включает очередь отправки для бота: методы отправки из METHODS заменяются постановкой в очередь.
+    Очередь сохраняется в атрибуте bot.outbox. При OUTBOX_WORKERS = 0 бот не изменяется.
+    :param bot: чат-бот
+    :return: очередь отправки или None
+    """
+    if bot_settings.OUTBOX_WORKERS <= 0:
+        return None
+    outbox = Outbox(bot, bot_settings.OUTBOX_WORKERS, bot_settings.OUTBOX_GLOBAL_RATE,
+                    bot_settings.OUTBOX_CHAT_RATE, bot_settings.OUTBOX_CHAT_BURST, bot_settings.OUTBOX_MERGE_DELAY)
+    for method in METHODS:
+        setattr(bot, method, queued(outbox, method))
+    bot.outbox = outbox
+    bot_metrics.Collected('bot_outbox_requests', 'Запросы к Telegram, ожидающие отправки', 'gauge', (),
+                          lambda: {(): outbox.stats()['requests']})
+    return outbox
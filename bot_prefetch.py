@@ -0,0 +1,125 @@
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List
+from loguru import logger
+import bot_settings
+import bot_transport
+from bot_cache import TTLCache
+from bot_classes import ApiQuest, QUERY_ERROR, SITE_ERROR
+
+prefetched = TTLCache('prefetch', bot_settings.PREFETCH_CACHE_SIZE, bot_settings.PREFETCH_TTL)
+
+
+def load_info(api_key: str, hotel_id: str, check_in: str, check_out: str, persons: str, currency: str,
+              lang: str) -> str:
+    """
+    Запрашивает у API информацию об одном отеле. Выполняется в пуле потоков.
+    :return: строка, содержащая полную информацию об отеле
+    """
+    return ApiQuest(api_key, hotel_id, check_in, check_out, persons, currency, lang).get_one_hotel()
+
+
+def load_pics(api_key: str, hotel_id: str) -> List[str]:
+    """
+    Запрашивает у API список url изображений отеля. Выполняется в пуле потоков.
+    :return: список url изображений
+    """
+    return ApiQuest(api_key, hotel_id).get_hotel_pics()
+
+
+def shared_future(key: Hashable, submit: Callable[[], Future], failed: Callable[[Any], bool]) -> Future:
+    """
+    Возвращает future из кэша или запускает запрос, если его еще нет. Запрос, завершившийся
+    исключением или неудачным результатом, удаляется из кэша, и следующее обращение запускает его заново.
+    :param key: ключ кэша
+    :param submit: функция, запускающая запрос в пуле потоков
+    :param failed: функция, проверяющая, что результат запроса неудачный
+    :return: future запроса
+    """
+    started = []
+
+    def start() -> Future:
+        started.append(submit())
+        return started[0]
+
+    future = prefetched.get_or_create(key, start)
+    if started:
+        future.add_done_callback(lambda done: evict_failed(key, done, failed))
+    return future
+
+
+def evict_failed(key: Hashable, future: Future, failed: Callable[[Any], bool]) -> None:
+    """
+    Удаляет из кэша завершившийся future, если запрос завершился исключением или неудачным результатом
+    :param key: ключ кэша
+    :param future: завершившийся future
+    :param failed: функция, проверяющая, что результат запроса неудачный
+    """
+    if future.cancelled() or future.exception() is not None or failed(future.result()):
+        prefetched.discard(key, future)
+
+
+def info_future(api_key: str, hotel_id: str, check_in: str, check_out: str, persons: str, currency: str,
+                lang: str) -> Future:
+    """
+    Возвращает future с информацией об отеле. Если запрос еще не запускался, запускает его в пуле потоков.
+    :param api_key: токен подключения к rapidapi
+    :param hotel_id: id отеля
+    :param check_in: дата заезда
+    :param check_out: дата выезда
+    :param persons: количество проживающих
+    :param currency: используемая валюта
+    :param lang: язык поиска
+    :return: future, результатом которого будет строка с информацией об отеле
+    """
+    executor = bot_transport.get_executor('details')
+    return shared_future(('info', hotel_id, check_in, check_out, persons, currency, lang),
+                         lambda: executor.submit(load_info, api_key, hotel_id, check_in, check_out,
+                                                 persons, currency, lang),
+                         lambda info: info in (SITE_ERROR, QUERY_ERROR))
+
+
+def pics_future(api_key: str, hotel_id: str) -> Future:
+    """
+    Возвращает future со списком изображений отеля. Если запрос еще не запускался, запускает его в пуле потоков.
+    :param api_key: токен подключения к rapidapi
+    :param hotel_id: id отеля
+    :return: future, результатом которого будет список url изображений
+    """
+    executor = bot_transport.get_executor('details')
+    return shared_future(('pics', hotel_id), lambda: executor.submit(load_pics, api_key, hotel_id),
+                         lambda pics: not pics)
+
+
+def prefetch_hotel(api_key: str, hotel_id: str, check_in: str, check_out: str, persons: str, currency: str,
+                   lang: str) -> None:
+    """
+    Одновременно запускает запросы информации и изображений отеля, не дожидаясь результата
+    """
+    logger.info('Предварительная загрузка данных отеля {}', hotel_id)
+    info_future(api_key, hotel_id, check_in, check_out, persons, currency, lang)
+    pics_future(api_key, hotel_id)
+
+
+def get_info(api_key: str, hotel_id: str, check_in: str, check_out: str, persons: str, currency: str,
+             lang: str) -> str:
+    """
+    Возвращает информацию об отеле, дожидаясь завершения запроса, если он еще выполняется
+    :return: строка, содержащая полную информацию об отеле
+    """
+    try:
+        return info_future(api_key, hotel_id, check_in, check_out, persons, currency, lang).result()
+    except Exception as err:
+        logger.warning('Ошибка при получении информации об отеле {}: {}', hotel_id, err)
+        return SITE_ERROR
+
+
+def get_pics(api_key: str, hotel_id: str) -> List[str]:
+    """
+    Возвращает список изображений отеля, дожидаясь завершения запроса, если он еще выполняется
+    :return: список url изображений
+    """
+    try:
+        return pics_future(api_key, hotel_id).result()
+    except Exception as err:
+        logger.warning('Ошибка при получении изображений отеля {}: {}', hotel_id, err)
+        return []
@@ -0,0 +1,150 @@
+import threading
+import time
+import zlib
+from typing import Optional, Tuple
+from loguru import logger
+import bot_settings
+from bot_classes import db, city_cache, Session, History, HistoryArchive
+
+_thread: Optional[threading.Thread] = None
+
+
+def db_size() -> int:
+    """
+    Возвращает размер базы данных в байтах без учета свободных страниц
+    :return: размер в байтах
+    """
+    page_size = db.execute_sql('PRAGMA page_size').fetchone()[0]
+    page_count = db.execute_sql('PRAGMA page_count').fetchone()[0]
+    free_pages = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    return (page_count - free_pages) * page_size
+
+
+@logger.catch
+def enable_incremental_vacuum() -> None:
+    """
+    Переводит базу данных в режим auto_vacuum=incremental. Для существующей базы режим
+    вступает в силу только после полного VACUUM, который выполняется один раз.
+    """
+    if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    logger.info('Перевод базы данных в режим incremental vacuum')
+    db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+    db.execute_sql('VACUUM')
+
+
+def archive_history(keep: int, batch_size: int) -> Tuple[int, int]:
+    """
+    Переносит записи истории старше keep последних для каждого чата в таблицу HistoryArchive,
+    сжимая список отелей. Перенос выполняется порциями в отдельных транзакциях.
+    :param keep: сколько последних записей истории чата оставить в таблице History
+    :param batch_size: количество записей в одной порции
+    :return: количество перенесенных записей и их размер до сжатия в байтах
+    """
+    query = f'SELECT id, chat_id, hotels, t_stamp FROM (SELECT id, chat_id, hotels, t_stamp, ' \
+            f'ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY t_stamp DESC) AS position ' \
+            f'FROM {History._meta.table_name}) WHERE position > ? LIMIT ?'
+    moved = 0
+    raw_bytes = 0
+    while True:
+        rows = db.execute_sql(query, (max(keep, 1), batch_size)).fetchall()
+        if not rows:
+            break
+        with db.atomic():
+            HistoryArchive.insert_many(
+                [{'chat_id': chat_id, 'hotels': zlib.compress(hotels.encode('utf-8')), 't_stamp': t_stamp}
+                 for _, chat_id, hotels, t_stamp in rows]).execute()
+            History.delete().where(History.id.in_([row[0] for row in rows])).execute()
+        moved += len(rows)
+        raw_bytes += sum(len(row[2].encode('utf-8')) for row in rows)
+    return moved, raw_bytes
+
+
+def trim_sessions(keep: int, batch_size: int) -> int:
+    """
+    Удаляет сессии старше keep последних для каждого чата. Сессии, на которые ссылается
+    оставшаяся запись истории, сохраняются: они нужны для вывода легенды /history.
+    :param keep: сколько последних сессий чата оставить
+    :param batch_size: количество записей в одной порции
+    :return: количество удаленных сессий
+    """
+    query = f'SELECT id FROM (SELECT id, chat_id, t_stamp, ' \
+            f'ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY t_stamp DESC) AS position ' \
+            f'FROM {Session._meta.table_name}) AS s WHERE position > ? AND NOT EXISTS ' \
+            f'(SELECT 1 FROM {History._meta.table_name} AS h ' \
+            f'WHERE h.chat_id = CAST(s.chat_id AS TEXT) AND h.t_stamp = s.t_stamp) LIMIT ?'
+    deleted = 0
+    while True:
+        ids = [row[0] for row in db.execute_sql(query, (max(keep, 1), batch_size)).fetchall()]
+        if not ids:
+            break
+        with db.atomic():
+            deleted += Session.delete().where(Session.id.in_(ids)).execute()
+    return deleted
+
+
+def trim_city_cache() -> int:
+    """
+    Удаляет из постоянного уровня кэша городов записи старше CITY_CACHE_TTL
+    :return: количество удаленных записей
+    """
+    if city_cache.persistent is None:
+        return 0
+    return city_cache.persistent.trim(city_cache.ttl)
+
+
+def vacuum(pages: int) -> None:
+    """
+    Возвращает операционной системе до pages свободных страниц базы данных
+    и переносит журнал WAL в основной файл базы
+    :param pages: максимальное количество освобождаемых страниц
+    """
+    # Модуль sqlite3 выполняет один шаг PRAGMA без результата, освобождая одну страницу,
+    # executescript выполняет команду полностью
+    db.connection().executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+@logger.catch
+def compact() -> None:
+    """
+    Очищает базу данных: переносит старую историю в архив, удаляет старые сессии и устаревшие
+    записи кэша городов, освобождает место в файле базы. Результат записывается в лог.
+    """
+    size_before = db_size()
+    archived, raw_bytes = archive_history(bot_settings.RETENTION_KEEP_HISTORY, bot_settings.RETENTION_BATCH)
+    deleted = trim_sessions(bot_settings.RETENTION_KEEP_SESSIONS, bot_settings.RETENTION_BATCH)
+    cities = trim_city_cache()
+    free_before = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    vacuum(bot_settings.RETENTION_VACUUM_PAGES)
+    free_after = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+    page_size = db.execute_sql('PRAGMA page_size').fetchone()[0]
+    logger.info('Очистка базы: в архив перенесено записей истории {} ({} байт до сжатия), удалено сессий {}, '
+                'записей кэша городов {}, данные уменьшились на {} байт, файлу возвращено {} байт', archived,
+                raw_bytes, deleted, cities, size_before - db_size(), (free_before - free_after) * page_size)
+
+
+def _run(interval: float) -> None:
+    """
+    Цикл фоновой очистки базы данных
+    :param interval: период очистки в секундах
+    """
+    while True:
+        compact()
+        time.sleep(interval)
+
+
+def start() -> None:
+    """
+    Запускает фоновую очистку базы данных с периодом RETENTION_INTERVAL секунд.
+    При RETENTION_INTERVAL = 0 очистка не выполняется. Однократный полный VACUUM для перевода базы
+    в режим incremental vacuum выполняется сразу, до запуска получения обновлений: пока он идет,
+    база заблокирована для всех соединений.
+    """
+    global _thread
+    if bot_settings.RETENTION_INTERVAL <= 0 or _thread is not None:
+        return
+    enable_incremental_vacuum()
+    _thread = threading.Thread(target=_run, args=(bot_settings.RETENTION_INTERVAL,),
+                               name='db-retention', daemon=True)
+    _thread.start()
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List
+from loguru import logger
+
+_STOP = object()
+
+
+def chat_key(args: tuple) -> Hashable:
+    """
+    Определяет id чата по аргументам обработчика: сообщению или вызову из inline-клавиатуры
+    :param args: аргументы обработчика
+    :return: id чата или None, если чат определить не удалось
+    """
+    for one_arg in args:
+        chat = getattr(one_arg, 'chat', None)
+        if chat is not None:
+            return chat.id
+        message = getattr(one_arg, 'message', None)
+        if message is not None and getattr(message, 'chat', None) is not None:
+            return message.chat.id
+    return None
+
+
+class ChatScheduler:
+
+    """
+    Пул потоков-обработчиков, сохраняющий порядок обработки внутри одного чата.
+    Задачи одного чата выполняются строго по очереди, разные чаты обрабатываются параллельно.
+    После каждой задачи чат перемещается в конец очереди готовых чатов, поэтому один активный чат
+    не задерживает остальные. Заменяет пул потоков TeleBot (bot.worker_pool).
+    Количество задач одного чата и всех чатов ограничено: если места нет, put ждет его освобождения,
+    поэтому поток, получающий обновления, приостанавливается вместо того, чтобы терять их.
+    """
+
+    def __init__(self, workers: int, chat_queue_limit: int, max_tasks: int = 0, put_timeout: float = 0):
+        """
+        первичная инициализация класса
+        :param workers: количество потоков-обработчиков
+        :param chat_queue_limit: максимальное количество задач одного чата, включая выполняемую
+        :param max_tasks: максимальное количество задач всех чатов, 0 - без ограничения
+        :param put_timeout: сколько секунд ждать места для задачи, после чего она отбрасывается,
+        0 - ждать без ограничения
+        """
+        self.chat_queue_limit: int = chat_queue_limit
+        self.max_tasks: int = max_tasks
+        self.put_timeout: float = put_timeout
+        self.dropped: int = 0
+        self.completed: int = 0
+        self.failed: int = 0
+        self.exception_event = threading.Event()
+        self._chats: Dict[Hashable, deque] = {}
+        self._tasks: int = 0
+        self._ready: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._workers: List[threading.Thread] = [
+            threading.Thread(target=self._work, name=f'chat-worker-{number}', daemon=True)
+            for number in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _full(self, key: Hashable) -> bool:
+        """
+        Проверяет, заполнена ли очередь чата или общее количество задач. Вызывается под блокировкой.
+        :param key: id чата
+        :return: True, если новую задачу чата поставить нельзя
+        """
+        tasks = self._chats.get(key)
+        return (tasks is not None and len(tasks) >= self.chat_queue_limit) or \
+            (self.max_tasks > 0 and self._tasks >= self.max_tasks)
+
+    def put(self, func: Callable, *args: Any, **kwargs: Any) -> None:
+        """
+        Добавляет задачу в очередь ее чата. Если очередь чата или общее количество задач заполнены,
+        ждет освобождения места не дольше put_timeout секунд, после чего задача отбрасывается.
+        :param func: обработчик
+        :param args: аргументы обработчика
+        :param kwargs: именованные аргументы обработчика
+        """
+        key = chat_key(args)
+        deadline = time.monotonic() + self.put_timeout if self.put_timeout > 0 else None
+        with self._lock:
+            while self._full(key):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.dropped += 1
+                    logger.warning('Очередь чата {} переполнена, задача отброшена', key)
+                    return
+                self._room.wait(remaining)
+            tasks = self._chats.get(key)
+            schedule = tasks is None
+            if schedule:
+                tasks = self._chats[key] = deque()
+            tasks.append((func, args, kwargs))
+            self._tasks += 1
+        if schedule:
+            self._ready.put(key)
+
+    def _work(self) -> None:
+        """
+        Цикл потока-обработчика. Задача остается в очереди чата до завершения,
+        поэтому пока она выполняется, другие потоки задачи этого чата не берут.
+        """
+        while True:
+            key = self._ready.get()
+            if key is _STOP:
+                break
+            with self._lock:
+                func, args, kwargs = self._chats[key][0]
+            try:
+                func(*args, **kwargs)
+                failed = False
+            except Exception:
+                logger.exception('Ошибка в обработчике чата {}', key)
+                failed = True
+            with self._lock:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+                self._tasks -= 1
+                self._room.notify_all()
+                tasks = self._chats[key]
+                tasks.popleft()
+                if not tasks:
+                    del self._chats[key]
+                    if not self._chats:
+                        self._idle.notify_all()
+            if tasks:
+                self._ready.put(key)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает количество чатов с задачами, количество невыполненных задач, выполненных задач,
+        задач, завершившихся ошибкой, и отброшенных задач
+        :return: словарь со статистикой
+        """
+        with self._lock:
+            return {'chats': len(self._chats), 'tasks': self._tasks, 'completed': self.completed,
+                    'failed': self.failed, 'dropped': self.dropped}
+
+    def raise_exceptions(self) -> None:
+        """
+        Совместимость с пулом потоков TeleBot. Ошибки обработчиков записываются в лог и не прерывают опрос.
+        """
+
+    def clear_exceptions(self) -> None:
+        """
+        Совместимость с пулом потоков TeleBot
+        """
+
+    def close(self) -> None:
+        """
+        Дожидается выполнения уже поставленных задач и останавливает потоки-обработчики
+        """
+        with self._idle:
+            self._idle.wait_for(lambda: not self._chats)
+        for _ in self._workers:
+            self._ready.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+
+
+def install(bot, scheduler: ChatScheduler) -> ChatScheduler:
+    """
+    Заменяет пул потоков бота. Предыдущий пул (util.ThreadPool TeleBot или ChatScheduler)
+    останавливается, иначе его потоки остаются работать без задач.
+    :param bot: чат-бот
+    :param scheduler: новый пул потоков
+    :return: новый пул потоков
+    """
+    previous = getattr(bot, 'worker_pool', None)
+    if previous is not None:
+        previous.close()
+    bot.worker_pool = scheduler
+    return scheduler
@@ -0,0 +1,170 @@
+import os
+from typing import Dict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Возвращает целочисленное значение переменной окружения
+    :param name: имя переменной окружения
+    :param default: значение по умолчанию
+    :return: значение переменной
+    """
+    return int(os.getenv(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Возвращает значение переменной окружения с плавающей точкой
+    :param name: имя переменной окружения
+    :param default: значение по умолчанию
+    :return: значение переменной
+    """
+    return float(os.getenv(name, default))
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """
+    Возвращает логическое значение переменной окружения
+    :param name: имя переменной окружения
+    :param default: значение по умолчанию
+    :return: значение переменной
+    """
+    return os.getenv(name, str(default)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Потоки обработчиков сообщений. Сообщения одного чата обрабатываются строго по очереди
+HANDLER_WORKERS: int = env_int('HANDLER_WORKERS', 8)
+CHAT_QUEUE_LIMIT: int = env_int('CHAT_QUEUE_LIMIT', 20)
+# Общее ограничение задач обработчиков и время ожидания места для новой задачи (0 - ждать без ограничения)
+HANDLER_MAX_TASKS: int = env_int('HANDLER_MAX_TASKS', 200)
+HANDLER_PUT_TIMEOUT: float = env_float('HANDLER_PUT_TIMEOUT', 0)
+
+# Очередь отправки сообщений в Telegram. OUTBOX_WORKERS = 0 - сообщения отправляются из обработчиков напрямую.
+# Telegram ограничивает бота примерно 30 сообщениями в секунду и одним сообщением в секунду в чат
+OUTBOX_WORKERS: int = env_int('OUTBOX_WORKERS', 4)
+OUTBOX_GLOBAL_RATE: float = env_float('OUTBOX_GLOBAL_RATE', 30)
+OUTBOX_CHAT_RATE: float = env_float('OUTBOX_CHAT_RATE', 1)
+OUTBOX_CHAT_BURST: float = env_float('OUTBOX_CHAT_BURST', 3)
+OUTBOX_MERGE_DELAY: float = env_float('OUTBOX_MERGE_DELAY', 0.05)
+OUTBOX_CLOSE_TIMEOUT: float = env_float('OUTBOX_CLOSE_TIMEOUT', 10)
+
+# Сколько месяцев календаря хранить готовыми клавиатурами
+CALENDAR_CACHE_SIZE: int = env_int('CALENDAR_CACHE_SIZE', 64)
+
+# Режим работы бота: polling - опрос серверов Telegram, webhook - прием обновлений локальным http-сервером
+BOT_RUNTIME: str = os.getenv('BOT_RUNTIME', 'polling')
+
+# Режим webhook
+WEBHOOK_URL: str = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST: str = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT: int = env_int('WEBHOOK_PORT', 8443)
+WEBHOOK_PATH: str = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET: str = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_QUEUE_SIZE: int = env_int('WEBHOOK_QUEUE_SIZE', 1000)
+WEBHOOK_ENQUEUE_TIMEOUT: float = env_float('WEBHOOK_ENQUEUE_TIMEOUT', 1)
+WEBHOOK_REPORT_INTERVAL: float = env_float('WEBHOOK_REPORT_INTERVAL', 60)
+
+# Адрес API hotels4. Может быть заменен на локальный сервер, например при нагрузочном тесте
+API_BASE_URL: str = os.getenv('API_BASE_URL', 'https://hotels4.p.rapidapi.com')
+
+# Пул соединений с rapidapi.com
+API_POOL_SIZE: int = env_int('API_POOL_SIZE', 10)
+# Одинаковые одновременные запросы к API выполняются один раз
+API_COALESCE: bool = env_bool('API_COALESCE', True)
+API_MAX_RETRIES: int = env_int('API_MAX_RETRIES', 3)
+API_BACKOFF: float = env_float('API_BACKOFF', 0.5)
+API_BACKOFF_MAX: float = env_float('API_BACKOFF_MAX', 8.0)
+API_WORKERS: int = env_int('API_WORKERS', 8)
+API_CONNECT_TIMEOUT: float = env_float('API_CONNECT_TIMEOUT', 3.05)
+
+# Таймауты чтения для каждого из адресов API, в секундах
+API_READ_TIMEOUTS: Dict[str, float] = {
+    'locations/search': env_float('API_TIMEOUT_CITY', 10),
+    'properties/list': env_float('API_TIMEOUT_HOTELS', 20),
+    'properties/get-details': env_float('API_TIMEOUT_DETAILS', 15),
+    'properties/get-hotel-photos': env_float('API_TIMEOUT_PICS', 15),
+}
+API_READ_TIMEOUT_DEFAULT: float = env_float('API_READ_TIMEOUT', 15)
+
+# Кэш поиска городов
+CITY_CACHE_SIZE: int = env_int('CITY_CACHE_SIZE', 1000)
+CITY_CACHE_TTL: float = env_float('CITY_CACHE_TTL', 24 * 60 * 60)
+CITY_CACHE_PERSIST: bool = env_bool('CITY_CACHE_PERSIST', True)
+
+# Кэш результатов поиска отелей, общий для всех чатов
+HOTELS_CACHE_SIZE: int = env_int('HOTELS_CACHE_SIZE', 500)
+HOTELS_CACHE_BYTES: int = env_int('HOTELS_CACHE_BYTES', 16 * 1024 * 1024)
+HOTELS_CACHE_TTL: float = env_float('HOTELS_CACHE_TTL', 5 * 60)
+HOTELS_CACHE_STALE_TTL: float = env_float('HOTELS_CACHE_STALE_TTL', 10 * 60)
+
+# Каталог отелей по направлениям: сколько секунд данные каталога используются для /bestdeal
+# без обращения к API (0 - каталог не используется) и сколько наборов направлений хранить
+CATALOG_TTL: float = env_float('CATALOG_TTL', 15 * 60)
+CATALOG_MAX_SLICES: int = env_int('CATALOG_MAX_SLICES', 200)
+
+# Параллельная загрузка страниц в цепочке /bestdeal
+BESTDEAL_PREFETCH_PAGES: int = env_int('BESTDEAL_PREFETCH_PAGES', 3)
+BESTDEAL_MAX_PAGES: int = env_int('BESTDEAL_MAX_PAGES', 20)
+
+# Предварительная загрузка информации и изображений отелей
+PREFETCH_TTL: float = env_float('PREFETCH_TTL', 10 * 60)
+PREFETCH_CACHE_SIZE: int = env_int('PREFETCH_CACHE_SIZE', 1000)
+PREFETCH_ON_LIST: int = env_int('PREFETCH_ON_LIST', 0)
+
+# Вариант размера изображений отеля, подставляемый в шаблон {size}
+PICS_SIZE: str = os.getenv('PICS_SIZE', 'z')
+
+# База данных sqlite. Отрицательный DB_CACHE_SIZE задает размер кэша страниц в КиБ
+DB_PATH: str = os.getenv('DB_PATH', 'bot_sessions.db')
+DB_JOURNAL_MODE: str = os.getenv('DB_JOURNAL_MODE', 'wal')
+DB_SYNCHRONOUS: str = os.getenv('DB_SYNCHRONOUS', 'normal')
+DB_CACHE_SIZE: int = env_int('DB_CACHE_SIZE', -16 * 1024)
+DB_MMAP_SIZE: int = env_int('DB_MMAP_SIZE', 64 * 1024 * 1024)
+DB_BUSY_TIMEOUT: float = env_float('DB_BUSY_TIMEOUT', 5)
+
+# Очистка базы данных: сколько последних сессий и записей истории хранить для каждого чата,
+# период очистки в секундах (0 - не выполнять) и размер порции удаляемых записей
+RETENTION_KEEP_SESSIONS: int = env_int('RETENTION_KEEP_SESSIONS', 5)
+RETENTION_KEEP_HISTORY: int = env_int('RETENTION_KEEP_HISTORY', 5)
+RETENTION_INTERVAL: float = env_float('RETENTION_INTERVAL', 60 * 60)
+RETENTION_BATCH: int = env_int('RETENTION_BATCH', 500)
+RETENTION_VACUUM_PAGES: int = env_int('RETENTION_VACUUM_PAGES', 1000)
+
+# Хранилище сессий в памяти. SESSION_WRITE_MODE: batch - отложенная запись в базу данных
+# одной транзакцией, direct - запись каждого изменения сразу
+SESSION_WRITE_MODE: str = os.getenv('SESSION_WRITE_MODE', 'batch')
+SESSION_JOURNAL: str = os.getenv('SESSION_JOURNAL', 'session_journal.log')
+SESSION_JOURNAL_FSYNC: bool = env_bool('SESSION_JOURNAL_FSYNC', False)
+SESSION_FLUSH_INTERVAL: float = env_float('SESSION_FLUSH_INTERVAL', 2)
+SESSION_IDLE_TTL: float = env_float('SESSION_IDLE_TTL', 24 * 60 * 60)
+
+# Через сколько секунд назначенный шаг цепочки опроса перестает ожидать ответа пользователя
+STEP_TTL: float = env_float('STEP_TTL', 24 * 60 * 60)
+
+# Логирование. LOG_LEVELS задает уровни отдельных модулей, например bots_funcs=WARNING,bot_cache=ERROR.
+# Большие объекты в логе обрезаются до LOG_PAYLOAD_LIMIT символов и записываются
+# только каждый LOG_PAYLOAD_SAMPLE-й раз
+LOG_FILE: str = os.getenv('LOG_FILE', 'hotel_logging.log')
+LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS: str = os.getenv('LOG_LEVELS', '')
+LOG_STDERR: bool = env_bool('LOG_STDERR', True)
+LOG_ROTATION: int = env_int('LOG_ROTATION', 100 * 1024 * 1024)
+LOG_QUEUE_SIZE: int = env_int('LOG_QUEUE_SIZE', 10000)
+LOG_PAYLOAD_LIMIT: int = env_int('LOG_PAYLOAD_LIMIT', 500)
+LOG_PAYLOAD_SAMPLE: int = env_int('LOG_PAYLOAD_SAMPLE', 1)
+
+# Метрики в формате Prometheus: http-сервер /metrics (METRICS_PORT = 0 - выключен)
+# и периодическая запись в файл (METRICS_FILE пустой - выключена)
+METRICS_HOST: str = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT: int = env_int('METRICS_PORT', 0)
+METRICS_FILE: str = os.getenv('METRICS_FILE', '')
+METRICS_INTERVAL: float = env_float('METRICS_INTERVAL', 60)
+
+# Запуск в нескольких процессах (supervisor.py)
+SHARD_WORKERS: int = env_int('SHARD_WORKERS', os.cpu_count() or 1)
+SHARD_QUEUE_SIZE: int = env_int('SHARD_QUEUE_SIZE', 1000)
+SHARD_BENCH_SEARCHES: int = env_int('SHARD_BENCH_SEARCHES', 200)
+SHARD_BENCH_API_LATENCY: float = env_float('SHARD_BENCH_API_LATENCY', 0.05)
@@ -0,0 +1,307 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from loguru import logger
+import bot_metrics
+import bot_settings
+from bot_classes import db, Session
+
+SESSION_FIELDS: List[str] = ['chat_id', 'state', 'lang', 'city', 'location', 'hot_num', 'persons', 'check_in',
+                             'check_out', 'currency', 'start_price', 'stop_price', 't_stamp', 'distance']
+
+
+class SessionStore:
+
+    """
+    Хранилище сессий пользователей в памяти.
+    Во время цепочки опроса источником данных является память, в таблицу Session изменения
+    записываются отложенно фоновым потоком. Каждое изменение сначала попадает в журнал на диске,
+    поэтому после аварийного завершения несохраненные сессии восстанавливаются из журнала.
+    При batch=False каждое изменение сразу записывается в базу данных отдельным запросом.
+    """
+
+    def __init__(self, journal: str, flush_interval: float, idle_ttl: float, fsync: bool = False,
+                 batch: bool = True):
+        """
+        первичная инициализация класса
+        :param journal: путь к файлу журнала
+        :param flush_interval: период записи изменений в базу данных в секундах
+        :param idle_ttl: через сколько секунд бездействия сохраненная сессия удаляется из памяти
+        :param fsync: сбрасывать ли журнал на диск после каждой записи
+        :param batch: группировать ли изменения в одну транзакцию отложенной записи
+        """
+        self.journal: str = journal
+        self.flush_interval: float = flush_interval
+        self.idle_ttl: float = idle_ttl
+        self.fsync: bool = fsync
+        self.batch: bool = batch
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._touched: Dict[str, float] = {}
+        self._dirty: set = set()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._journal_file = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Восстанавливает сессии из журнала и запускает фоновую запись в базу данных
+        """
+        self.recover()
+        self._thread = threading.Thread(target=self._run, name='session-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Останавливает фоновую запись и сохраняет все изменения в базу данных
+        """
+        self._stop.set()
+        self.flush()
+
+    def _run(self) -> None:
+        """
+        Цикл фоновой записи изменений в базу данных
+        """
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as err:
+                logger.error('Ошибка при сохранении сессий в базу: {}', err)
+
+    def _save(self, key: str, record: Dict[str, Any]) -> None:
+        """
+        Сохраняет изменение сессии: в режиме batch дописывает его в журнал и откладывает запись в базу,
+        иначе сразу записывает в базу. Вызывается под блокировкой.
+        :param key: id чата в виде строки
+        :param record: сессия целиком
+        """
+        if not self.batch:
+            save_session(record)
+            return
+        self._dirty.add(key)
+        self._write_journal(record)
+
+    def _write_journal(self, record: Dict[str, Any]) -> None:
+        """
+        Дописывает снимок сессии в журнал. Вызывается под блокировкой.
+        :param record: сессия целиком
+        """
+        if self._journal_file is None:
+            self._journal_file = open(self.journal, 'a', encoding='utf-8')
+        self._journal_file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+        self._journal_file.flush()
+        if self.fsync:
+            os.fsync(self._journal_file.fileno())
+
+    def create(self, chat_id: int, state: str, tm_stamp: float) -> None:
+        """
+        Начинает новую сессию чата
+        :param chat_id: id чата
+        :param state: тип цепочки (low, high, best)
+        :param tm_stamp: время ввода пользователем команды, после которой начинается цепочка
+        """
+        record = dict.fromkeys(SESSION_FIELDS)
+        record.update(chat_id=int(chat_id), state=Session.coerce('state', state), t_stamp=tm_stamp)
+        key = str(chat_id)
+        with self._lock:
+            self._sessions[key] = record
+            self._touched[key] = time.time()
+            self._save(key, record)
+
+    def update(self, chat_id: int, field: str, value: Any) -> None:
+        """
+        Изменяет поле последней сессии чата. Значение приводится к типу поля таблицы Session.
+        :param chat_id: id чата
+        :param field: название поля
+        :param value: значение поля
+        """
+        if field not in SESSION_FIELDS:
+            raise ValueError(f'Неизвестное поле сессии {field}')
+        value = Session.coerce(field, value)
+        key = str(chat_id)
+        with self._lock:
+            record = self._get(key)
+            if record is None:
+                logger.warning('Нет активной сессии для chat_id = {}', chat_id)
+                return
+            record[field] = value
+            self._touched[key] = time.time()
+            self._save(key, record)
+
+    def select(self, chat_id: int, *fields: str) -> Optional[List[Any]]:
+        """
+        Возвращает значения полей последней сессии чата
+        :param chat_id: id чата
+        :param fields: названия полей
+        :return: список значений или None, если сессии нет
+        """
+        key = str(chat_id)
+        with self._lock:
+            record = self._get(key)
+            if record is None:
+                return None
+            self._touched[key] = time.time()
+            return [record.get(field) for field in fields]
+
+    def find(self, chat_id: int, tm_stamp: float) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает сессию чата с заданным временем начала, если она находится в памяти
+        :param chat_id: id чата
+        :param tm_stamp: время начала цепочки
+        :return: копия сессии или None
+        """
+        with self._lock:
+            record = self._sessions.get(str(chat_id))
+            if record is not None and record['t_stamp'] == tm_stamp:
+                return dict(record)
+        return None
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает сессию из памяти, при отсутствии загружает последнюю сессию чата из базы.
+        Вызывается под блокировкой.
+        """
+        record = self._sessions.get(key)
+        if record is None:
+            row = Session.select().where(Session.chat_id == key).order_by(Session.t_stamp.desc()).limit(1)\
+                .dicts().first()
+            if row is not None:
+                record = {field: row[field] for field in SESSION_FIELDS}
+                self._sessions[key] = record
+        return record
+
+    def persist(self, chat_id: int) -> None:
+        """
+        Сразу записывает несохраненные изменения сессии чата в базу данных, не дожидаясь фоновой записи.
+        Вызывается перед назначением шага цепочки: шаг может забрать другой процесс бота, который
+        прочитает сессию из базы данных.
+        :param chat_id: id чата
+        """
+        key = str(chat_id)
+        with self._flush_lock:
+            with self._lock:
+                if key not in self._dirty:
+                    return
+                record = dict(self._sessions[key])
+                self._dirty.discard(key)
+            try:
+                save_session(record)
+            except Exception:
+                with self._lock:
+                    self._dirty.add(key)
+                raise
+
+    def reload(self, chat_id: int) -> None:
+        """
+        Перечитывает сессию чата из базы данных. Вызывается, когда процесс забирает шаг цепочки:
+        предыдущий шаг мог выполнить другой процесс, и сессия в памяти этого процесса устарела или отсутствует.
+        Сессия с несохраненными изменениями этого процесса не перечитывается.
+        :param chat_id: id чата
+        """
+        key = str(chat_id)
+        with self._lock:
+            if key in self._dirty:
+                return
+            self._sessions.pop(key, None)
+            if self._get(key) is not None:
+                self._touched[key] = time.time()
+
+    def flush(self) -> None:
+        """
+        Записывает измененные сессии в базу данных одной транзакцией.
+        Журнал, относящийся к записанным изменениям, после этого удаляется.
+        Записи выполняются по одной: иначе вторая запись дописала бы свой журнал в файл .flushing,
+        который первая удалит после своей транзакции, до того как вторая сохранит эти изменения.
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        """
+        Выполняет запись изменений в базу данных. Вызывается под блокировкой _flush_lock.
+        """
+        with self._lock:
+            if not self._dirty:
+                self._evict()
+                return
+            snapshot = [dict(self._sessions[key]) for key in self._dirty]
+            self._dirty.clear()
+            flushing = self.journal + '.flushing'
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+                if os.path.exists(flushing):
+                    with open(flushing, 'a', encoding='utf-8') as old, open(self.journal, encoding='utf-8') as new:
+                        old.write(new.read())
+                    os.remove(self.journal)
+                else:
+                    os.replace(self.journal, flushing)
+        started = time.perf_counter()
+        try:
+            with db.atomic():
+                for record in snapshot:
+                    save_session(record)
+        except Exception:
+            with self._lock:
+                self._dirty.update(str(record['chat_id']) for record in snapshot)
+            raise
+        bot_metrics.db_seconds.observe(time.perf_counter() - started, operation='session_flush')
+        if os.path.exists(flushing):
+            os.remove(flushing)
+        logger.info('Сохранено сессий в базу: {}', len(snapshot))
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Удаляет из памяти сохраненные сессии, к которым давно не обращались. Вызывается под блокировкой.
+        """
+        border = time.time() - self.idle_ttl
+        for key in [key for key, touched in self._touched.items() if touched < border and key not in self._dirty]:
+            self._sessions.pop(key, None)
+            self._touched.pop(key, None)
+
+    def recover(self) -> None:
+        """
+        Восстанавливает несохраненные сессии из журнала после аварийного завершения
+        """
+        records: Dict[tuple, Dict[str, Any]] = {}
+        for path in (self.journal + '.flushing', self.journal):
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as journal:
+                    for line in journal:
+                        try:
+                            record = {field: Session.coerce(field, value) for field, value in json.loads(line).items()}
+                        except ValueError:
+                            logger.warning('Пропущена поврежденная строка журнала сессий')
+                            continue
+                        records[(record['chat_id'], record['t_stamp'])] = record
+        if not records:
+            return
+        with db.atomic():
+            for record in records.values():
+                save_session(record)
+        for path in (self.journal + '.flushing', self.journal):
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info('Восстановлено сессий из журнала: {}', len(records))
+
+
+def save_session(record: Dict[str, Any]) -> None:
+    """
+    Сохраняет сессию в таблицу Session. Запись с тем же chat_id и t_stamp обновляется,
+    поэтому повторное сохранение одной и той же сессии безопасно.
+    :param record: сессия целиком
+    """
+    updated = Session.update(**{field: record[field] for field in SESSION_FIELDS}).where(
+        (Session.chat_id == record['chat_id']) & (Session.t_stamp == record['t_stamp'])).execute()
+    if not updated:
+        Session.insert(**{field: record[field] for field in SESSION_FIELDS}).execute()
+
+
+session_store = SessionStore(bot_settings.SESSION_JOURNAL, bot_settings.SESSION_FLUSH_INTERVAL,
+                             bot_settings.SESSION_IDLE_TTL, bot_settings.SESSION_JOURNAL_FSYNC,
+                             bot_settings.SESSION_WRITE_MODE != 'direct')
@@ -0,0 +1,97 @@
+import json
+import time
+from typing import Any, Callable, Dict
+from loguru import logger
+from telebot import types
+import bot_metrics
+import bot_settings
+from bot_classes import db, NextStep
+from bot_state import session_store
+
+BOT_ARG = '__bot__'
+
+STEPS: Dict[str, Callable] = {}
+
+
+def step(func: Callable) -> Callable:
+    """
+    Декоратор, регистрирующий функцию как шаг цепочки опроса пользователя.
+    Зарегистрированный шаг можно назначить обработчиком следующего сообщения через register_next_step.
+    Длительность шага записывается в метрики обработчиков.
+    :param func: функция-шаг, первым аргументом принимает сообщение
+    :return: функция-шаг с записью длительности
+    """
+    timed_func = bot_metrics.handler(func)
+    STEPS[func.__name__] = timed_func
+    return timed_func
+
+
+@bot_metrics.db_operation
+def register_next_step(message: types.Message, func: Callable, *args: Any) -> None:
+    """
+    Назначает обработчик следующего сообщения чата. В отличие от bot.register_next_step_handler
+    обработчик хранится в базе данных, поэтому переживает перезапуск бота и доступен всем процессам бота.
+    Перед назначением шага несохраненные изменения сессии чата записываются в базу данных,
+    а процесс, забравший шаг, перечитывает сессию из базы (resume_step).
+    :param message: сообщение, после которого ожидается ответ пользователя
+    :param func: зарегистрированная функция-шаг
+    :param args: аргументы функции после сообщения. Чат-бот сохраняется как ссылка и подставляется при вызове
+    """
+    if STEPS.get(func.__name__) is not func:
+        raise ValueError(f'Функция {func.__name__} не зарегистрирована как шаг')
+    session_store.persist(message.chat.id)
+    step_args = [BOT_ARG if hasattr(one_arg, 'send_message') else one_arg for one_arg in args]
+    NextStep.insert(chat_id=message.chat.id, step=func.__name__, args=json.dumps(step_args, ensure_ascii=False),
+                    t_stamp=time.time()).on_conflict_replace().execute()
+
+
+@bot_metrics.db_operation
+def claim_step(chat_id: int) -> Any:
+    """
+    Забирает назначенный шаг чата. Запись удаляется в той же транзакции, поэтому при нескольких
+    процессах бота, работающих с одной базой, шаг получит только один из них.
+    Транзакция сразу захватывает блокировку записи: в режиме WAL транзакция, начатая с чтения,
+    не может перейти к записи после чужой записи и завершается ошибкой database is locked без ожидания.
+    :param chat_id: id чата
+    :return: запись NextStep или None
+    """
+    with db.atomic('IMMEDIATE'):
+        pending = NextStep.get_or_none(NextStep.chat_id == chat_id)
+        if pending is None:
+            return None
+        claimed = NextStep.delete().where((NextStep.chat_id == chat_id) &
+                                          (NextStep.t_stamp == pending.t_stamp)).execute()
+    if not claimed or time.time() - pending.t_stamp > bot_settings.STEP_TTL:
+        return None
+    return pending
+
+
+def resume_step(bot, message: types.Message) -> bool:
+    """
+    Если для чата назначен шаг цепочки опроса, перечитывает сессию чата из базы данных
+    и вызывает шаг с полученным сообщением
+    :param bot: чат-бот
+    :param message: Полученное в чате сообщение
+    :return: True, если сообщение обработано шагом
+    """
+    pending = claim_step(message.chat.id)
+    if pending is None:
+        return False
+    func = STEPS.get(pending.step)
+    if func is None:
+        logger.warning('Неизвестный шаг {} для чата {}', pending.step, message.chat.id)
+        return False
+    args = [bot if one_arg == BOT_ARG else one_arg for one_arg in json.loads(pending.args)]
+    session_store.reload(message.chat.id)
+    logger.info('Продолжение цепочки: шаг {}, chat.id: {}', pending.step, message.chat.id)
+    func(message, *args)
+    return True
+
+
+@bot_metrics.db_operation
+def clear_step(chat_id: int) -> None:
+    """
+    Отменяет назначенный шаг чата
+    :param chat_id: id чата
+    """
+    NextStep.delete().where(NextStep.chat_id == chat_id).execute()
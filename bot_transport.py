@@ -0,0 +1,203 @@
+import copy
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from loguru import logger
+import bot_metrics
+import bot_settings
+
+RETRY_STATUSES: Tuple = (429, 500, 502, 503, 504)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def get_session() -> requests.Session:
+    """
+    Возвращает общую для всего процесса http-сессию с пулом keep-alive соединений.
+    Сессия создается при первом обращении.
+    :return: http-сессия
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=bot_settings.API_POOL_SIZE,
+                                      pool_maxsize=bot_settings.API_POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def get_executor(name: str) -> ThreadPoolExecutor:
+    """
+    Возвращает общий для процесса пул потоков для параллельных запросов к API.
+    Для разных задач используются разные пулы, чтобы задачи одного пула не ждали друг друга.
+    :param name: имя пула
+    :return: пул потоков
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        with _session_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=bot_settings.API_WORKERS, thread_name_prefix=f'api-{name}')
+                _executors[name] = executor
+    return executor
+
+
+def get_timeout(one_url: str) -> Tuple[float, float]:
+    """
+    Возвращает таймауты соединения и чтения для адреса API
+    :param one_url: url, по которому производится запрос
+    :return: кортеж (таймаут соединения, таймаут чтения)
+    """
+    for endpoint, read_timeout in bot_settings.API_READ_TIMEOUTS.items():
+        if one_url.endswith(endpoint):
+            return bot_settings.API_CONNECT_TIMEOUT, read_timeout
+    return bot_settings.API_CONNECT_TIMEOUT, bot_settings.API_READ_TIMEOUT_DEFAULT
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """
+    Вычисляет паузу перед повторной попыткой: экспоненциальный рост с полным джиттером.
+    Если сервер прислал заголовок Retry-After, используется он.
+    :param attempt: номер попытки, начиная с нуля
+    :param retry_after: значение заголовка Retry-After
+    :return: пауза в секундах
+    """
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), bot_settings.API_BACKOFF_MAX)
+    ceiling = min(bot_settings.API_BACKOFF * (2 ** attempt), bot_settings.API_BACKOFF_MAX)
+    return random.uniform(0, ceiling)
+
+
+def http_get(one_url: str, headers: Dict, query: Dict) -> requests.Response:
+    """
+    Выполняет GET-запрос через общий пул соединений.
+    При ответах 429/5xx и сетевых ошибках повторяет запрос не более API_MAX_RETRIES раз.
+    :param one_url: url, по которому производится запрос
+    :param headers: заголовки запроса
+    :param query: словарь, содержащий переменные, участвующие в запросе
+    :return: ответ сервера
+    """
+    session = get_session()
+    timeout = get_timeout(one_url)
+    attempt = 0
+    while True:
+        try:
+            response = session.get(one_url, headers=headers, params=query, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            if attempt >= bot_settings.API_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            bot_metrics.api_retries.inc(endpoint=bot_metrics.endpoint(one_url), reason='connection')
+            logger.warning('Ошибка соединения с {}: {}. Повтор через {:.2f} с', one_url, err, delay)
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= bot_settings.API_MAX_RETRIES:
+                return response
+            delay = backoff_delay(attempt, response.headers.get('Retry-After'))
+            bot_metrics.api_retries.inc(endpoint=bot_metrics.endpoint(one_url), reason=response.status_code)
+            logger.warning('Ответ {} от {}. Повтор через {:.2f} с', response.status_code, one_url, delay)
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_json(one_url: str, headers: Dict, query: Dict) -> Any:
+    """
+    Выполняет GET-запрос через общий пул соединений и возвращает десериализованный ответ
+    :param one_url: url, по которому производится запрос
+    :param headers: заголовки запроса
+    :param query: словарь, содержащий переменные, участвующие в запросе
+    :return: ответ сервера
+    """
+    response = http_get(one_url, headers, query)
+    logger.info('Получен ответ {}', response)
+    return response.json()
+
+
+class SingleFlight:
+
+    """
+    Объединение одинаковых одновременных запросов. Пока запрос с некоторым ключом выполняется,
+    остальные вызовы с тем же ключом не выполняют его повторно, а ждут и получают тот же результат или ту же ошибку.
+    """
+
+    def __init__(self):
+        """
+        первичная инициализация класса
+        """
+        self.calls: int = 0
+        self.shared: int = 0
+        self._flights: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Выполняет func или дожидается результата уже выполняющегося вызова с тем же ключом
+        :param key: ключ запроса
+        :param func: функция без аргументов, выполняющая запрос
+        :return: результат и признак того, что он получен чужим вызовом
+        """
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            shared = flight is not None
+            if shared:
+                self.shared += 1
+            else:
+                flight = self._flights[key] = Future()
+        if shared:
+            return flight.result(), True
+        try:
+            result = func()
+            flight.set_result(result)
+            return result, False
+        except BaseException as err:
+            flight.set_exception(err)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+    def ratio(self) -> float:
+        """
+        Возвращает долю вызовов, получивших результат чужого запроса
+        :return: доля от 0 до 1
+        """
+        with self._lock:
+            return self.shared / self.calls if self.calls else 0.0
+
+
+api_flights = SingleFlight()
+bot_metrics.Collected('bot_api_coalescing_ratio',
+                      'Доля запросов к API, получивших ответ одинакового одновременного запроса', 'gauge', (),
+                      lambda: {(): api_flights.ratio()})
+
+
+def get_json_shared(one_url: str, headers: Dict, query: Dict) -> Any:
+    """
+    Выполняет запрос как get_json, но одновременные запросы с одинаковыми адресом и параметрами
+    выполняются один раз. Выполнивший запрос получает сам ответ, остальные вызывающие - его копии,
+    поэтому каждый может изменять полученный ответ. При API_COALESCE = 0 запросы не объединяются.
+    :param one_url: url, по которому производится запрос
+    :param headers: заголовки запроса
+    :param query: словарь, содержащий переменные, участвующие в запросе
+    :return: ответ сервера
+    """
+    if not bot_settings.API_COALESCE:
+        return get_json(one_url, headers, query)
+    key = (one_url, tuple(sorted((name, str(value)) for name, value in query.items())))
+    result, shared = api_flights.do(key, lambda: get_json(one_url, headers, query))
+    if shared:
+        bot_metrics.api_coalesced.inc(endpoint=bot_metrics.endpoint(one_url))
+        return copy.deepcopy(result)
+    return result
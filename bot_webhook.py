@@ -0,0 +1,214 @@
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+import requests
+from loguru import logger
+from telebot import apihelper, types
+import bot_metrics
+import bot_settings
+
+
+class UpdateQueue:
+
+    """
+    Ограниченная очередь обновлений Telegram. Один поток в порядке поступления передает обновления боту,
+    который распределяет их по обработчикам в ChatScheduler с сохранением порядка внутри чата.
+    Когда в ChatScheduler нет места, поток ждет его освобождения, и очередь заполняется.
+    Если очередь заполнена, прием обновления ждет не дольше WEBHOOK_ENQUEUE_TIMEOUT секунд,
+    после чего обновление отклоняется и Telegram повторит его доставку позже.
+    """
+
+    def __init__(self, bot, maxsize: int, enqueue_timeout: float):
+        """
+        первичная инициализация класса
+        :param bot: чат-бот, обработчики которого получают обновления
+        :param maxsize: максимальная длина очереди
+        :param enqueue_timeout: сколько секунд ждать освобождения места в очереди
+        """
+        self.bot = bot
+        self.enqueue_timeout: float = enqueue_timeout
+        self.updates: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.received: int = 0
+        self.dispatched: int = 0
+        self.dropped: int = 0
+        self.failed: int = 0
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._work, name='webhook-dispatcher', daemon=True)
+
+    def start(self) -> None:
+        """
+        Запускает поток, передающий обновления боту
+        """
+        self._dispatcher.start()
+
+    def put(self, update: Dict) -> bool:
+        """
+        Помещает обновление в очередь
+        :param update: обновление Telegram в виде словаря
+        :return: True, если обновление принято, False, если очередь переполнена
+        """
+        try:
+            self.updates.put(update, timeout=self.enqueue_timeout)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning('Очередь обновлений переполнена, обновление {} отклонено', update.get('update_id'))
+            return False
+        with self._lock:
+            self.received += 1
+        return True
+
+    def _work(self) -> None:
+        """
+        Цикл потока, передающего обновления из очереди обработчикам бота
+        """
+        while True:
+            update = self.updates.get()
+            try:
+                self.bot.process_new_updates([types.Update.de_json(update)])
+                with self._lock:
+                    self.dispatched += 1
+            except Exception as err:
+                with self._lock:
+                    self.failed += 1
+                logger.error('Ошибка при обработке обновления {}: {}', update.get('update_id'), err)
+            finally:
+                self.updates.task_done()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает длину очереди и счетчики обновлений. Обработанными считаются обновления, обработчики
+        которых завершились; переданные боту, но еще не обработанные, учитываются в in_flight.
+        Отброшенные и завершившиеся ошибкой обновления включают задачи, отброшенные и завершившиеся ошибкой
+        в ChatScheduler.
+        :return: словарь со статистикой
+        """
+        scheduler = self.bot.worker_pool.stats()
+        with self._lock:
+            return {'queue_depth': self.updates.qsize(), 'in_flight': scheduler['tasks'], 'received': self.received,
+                    'dispatched': self.dispatched, 'processed': scheduler['completed'],
+                    'dropped': self.dropped + scheduler['dropped'], 'failed': self.failed + scheduler['failed']}
+
+
+def make_handler(update_queue: UpdateQueue, path: str, secret: Optional[str]):
+    """
+    Создает класс обработчика http-запросов для webhook
+    :param update_queue: очередь обновлений
+    :param path: путь, по которому Telegram присылает обновления
+    :param secret: секретный токен из заголовка X-Telegram-Bot-Api-Secret-Token, None - не проверять
+    :return: класс обработчика
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self) -> None:
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                self.send_error(403)
+                return
+            try:
+                update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError:
+                self.send_error(400)
+                return
+            if update_queue.put(update):
+                self.send_response(200)
+                self.end_headers()
+            else:
+                self.send_error(503)
+
+        def do_GET(self) -> None:
+            if self.path == '/stats':
+                body = json.dumps(update_queue.stats()).encode('utf-8')
+                content_type = 'application/json'
+            elif self.path == '/metrics':
+                body = bot_metrics.render().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    return WebhookHandler
+
+
+def report(update_queue: UpdateQueue, interval: float) -> None:
+    """
+    Периодически записывает в лог длину очереди и счетчики обновлений
+    :param update_queue: очередь обновлений
+    :param interval: период в секундах
+    """
+    while True:
+        time.sleep(interval)
+        logger.info('Webhook: {}', update_queue.stats())
+
+
+def set_webhook(bot, url: str, max_connections: int, secret: str) -> None:
+    """
+    Регистрирует webhook в Telegram. Метод set_webhook telebot 4.4.0 не передает secret_token,
+    поэтому запрос setWebhook выполняется напрямую.
+    :param bot: чат-бот
+    :param url: полный адрес webhook
+    :param max_connections: максимальное количество одновременных соединений от Telegram
+    :param secret: секретный токен, который Telegram будет передавать в заголовке X-Telegram-Bot-Api-Secret-Token,
+    пустая строка - не передавать
+    """
+    payload = {'url': url, 'max_connections': max_connections}
+    if secret:
+        payload['secret_token'] = secret
+    apihelper._make_request(bot.token, 'setWebhook', method='post', params=payload)
+
+
+def run(bot) -> None:
+    """
+    Запускает бота в режиме webhook: локальный http-сервер принимает обновления от Telegram
+    и помещает их в ограниченную очередь, откуда они передаются обработчикам бота.
+    Статистика очереди доступна по адресу /stats, метрики бота - по адресу /metrics.
+    :param bot: чат-бот
+    """
+    update_queue = UpdateQueue(bot, bot_settings.WEBHOOK_QUEUE_SIZE, bot_settings.WEBHOOK_ENQUEUE_TIMEOUT)
+    update_queue.start()
+    threading.Thread(target=report, args=(update_queue, bot_settings.WEBHOOK_REPORT_INTERVAL),
+                     name='webhook-report', daemon=True).start()
+    if bot_settings.WEBHOOK_URL:
+        bot.remove_webhook()
+        set_webhook(bot, bot_settings.WEBHOOK_URL + bot_settings.WEBHOOK_PATH, bot_settings.HANDLER_WORKERS,
+                    bot_settings.WEBHOOK_SECRET)
+    server = ThreadingHTTPServer((bot_settings.WEBHOOK_HOST, bot_settings.WEBHOOK_PORT),
+                                 make_handler(update_queue, bot_settings.WEBHOOK_PATH,
+                                              bot_settings.WEBHOOK_SECRET or None))
+    logger.info('Webhook слушает {}:{}{}', bot_settings.WEBHOOK_HOST, bot_settings.WEBHOOK_PORT,
+                bot_settings.WEBHOOK_PATH)
+    server.serve_forever()
+
+
+def replay(url: str, file_name: str) -> None:
+    """
+    Отправляет на webhook записанные обновления, заменяя собой серверы Telegram.
+    Файл содержит по одному обновлению в формате json на строку.
+    :param url: адрес webhook, например http://127.0.0.1:8443/webhook
+    :param file_name: файл с записанными обновлениями
+    """
+    headers = {'X-Telegram-Bot-Api-Secret-Token': bot_settings.WEBHOOK_SECRET} if bot_settings.WEBHOOK_SECRET else {}
+    with open(file_name, encoding='utf-8') as updates:
+        for line in updates:
+            if line.strip():
+                response = requests.post(url, data=line.encode('utf-8'), headers=headers)
+                logger.info('Обновление отправлено, ответ {}', response.status_code)
+
+
+if __name__ == '__main__':
+    replay(sys.argv[1], sys.argv[2])
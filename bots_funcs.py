@@ -1,11 +1,17 @@
 import time
 import datetime
+import functools
 import bot_database
-import json
+import bot_logging
+import bot_metrics
+import bot_prefetch
+import bot_settings
+import bot_steps
 from telebot import types
 from typing import Dict, List, Tuple
-from main import bot, my_rapi, logger
-from bot_classes import BotKeyboard, ApiQuest
+from loguru import logger
+from bot_core import bot, my_rapi
+from bot_classes import BotKeyboard, StaticKeyboard, ApiQuest, HotelRecord
 from telebot_calendar import Calendar, RUSSIAN_LANGUAGE, CallbackData
 hotel_messages: Dict = {'low': ['Ищем отели с демократическими ценами.', 'PRICE'],
                   'high': ['Ищем отели с максимальной стоимостью.', 'PRICE_HIGHEST_FIRST'],
@@ -13,6 +19,21 @@ hotel_messages: Dict = {'low': ['Ищем отели с демократичес
                   'error': ['Ошибка ввода. Лучше начните сначала. Будут выведены отели с низкими ценами.', 'PRICE']}
 calendar = Calendar(language=RUSSIAN_LANGUAGE)
 calendar_1_callback = CallbackData("calendar_1", "action", "year", "month", "day")
+lang_keyboard = BotKeyboard([('Русский', 'ru_RU.loc'), ('English', 'en_US.loc')], 2).create_keys(static=True)
+
+
+@functools.lru_cache(maxsize=bot_settings.CALENDAR_CACHE_SIZE)
+def calendar_keyboard(name: str, year: int, month: int, today: datetime.date) -> StaticKeyboard:
+    """
+    Возвращает клавиатуру календаря на месяц. Клавиатуры запоминаются; в календаре отмечена
+    текущая дата, поэтому она входит в ключ и со сменой дня клавиатуры строятся заново.
+    :param name: имя календаря
+    :param year: год
+    :param month: номер месяца
+    :param today: текущая дата
+    :return: клавиатура календаря
+    """
+    return StaticKeyboard(calendar.create_calendar(name=name, year=year, month=month).keyboard, 7)
 
 
 def service_message(bot, message: types.Message, sm_num: int) -> None:
@@ -43,6 +64,7 @@ def brake_chain(message: types.Message) -> bool:
         return True
 
 
+@bot_metrics.handler
 def command_router(bot, message: types.Message) -> None:
     """
     Запуск цепочки опроса пользователя, создание записи сессии в базе данных
@@ -51,7 +73,7 @@ def command_router(bot, message: types.Message) -> None:
     """
     tm_stamp = time.time()
     chat_id = message.chat.id
-    logger.info(f'Начало цепочки: {message.text}, chat.id: {message.chat.id}')
+    logger.info('Начало цепочки: {}, chat.id: {}', message.text, message.chat.id)
     if message.text == '/help':
         service_message(bot, message, 0)
         state = 'help'
@@ -78,47 +100,47 @@ def command_router(bot, message: types.Message) -> None:
         bot_database.create_record(chat_id, state, tm_stamp)
 
 
+@bot_metrics.handler
 def show_calendar(bot,
                   message: types.Message,
                   month: int = 0,
                   quest: str = 'Выберите дату заезда в отель',
-                  name: str = calendar_1_callback.prefix) -> None:
+                  name: str = calendar_1_callback.prefix,
+                  year: int = 0) -> None:
     """
     Создание inline-клавиатуры календаря
     :param bot: чат-бот
     :param message: Полученное в чате сообщение
-    :param month: номер месяца
+    :param month: номер месяца, 0 и 13 - декабрь предыдущего и январь следующего года
     :param quest: передаваемый пользователю вопрос
     :param name: имя передаваемого пользователю календаря
+    :param year: год, по умолчанию текущий
     """
-    now = datetime.datetime.now()
-    if month == 0:
-        month = now.month
+    today = datetime.date.today()
+    if month == 0 and year == 0:
+        month = today.month
+    year, month = divmod((year or today.year) * 12 + month - 1, 12)
     if name == 'calendar_2':
         quest = 'Выберите дату выезда'
     bot.send_message(
         message.chat.id,
         quest,
-        reply_markup=calendar.create_calendar(
-            name=name,
-            year=now.year,
-            month=month,
-        ),
+        reply_markup=calendar_keyboard(name, year, month + 1, today),
     )
 
 
+@bot_metrics.handler
 def get_locale(message: types.Message, bot) -> None:
     """
     Создает inline-клавиатуру для запроса языка у пользователя
     :param message: Полученное в чате сообщение
     :param bot: чат-бот
     """
-    this_keyboard = BotKeyboard([('Русский', 'ru_RU.loc'), ('English', 'en_US.loc')], 2)
-    keyboard = this_keyboard.create_keys()
     question = 'На каком языке будем искать?'
-    bot.send_message(message.from_user.id, text=question, reply_markup=keyboard)
+    bot.send_message(message.from_user.id, text=question, reply_markup=lang_keyboard)
 
 
+@bot_metrics.handler
 def get_lang(one_locale: str, in_message: types.CallbackQuery, bot) -> None:
     """
     Принимает выбранное значение из inline-клавиатуры, созданной в get_locale
@@ -129,9 +151,10 @@ def get_lang(one_locale: str, in_message: types.CallbackQuery, bot) -> None:
     """
     bot_database.update_record('lang', one_locale, in_message.message.chat.id)
     msg = bot.send_message(in_message.from_user.id, 'В каком городе ищем отели? ')
-    bot.register_next_step_handler(msg, get_city, bot)
+    bot_steps.register_next_step(msg, get_city, bot)
 
 
+@bot_steps.step
 def get_city(message: types.Message, bot) -> None:
     """
     Вызывает find_city для получения списка городов. Если получен список более чем из одного элемена,
@@ -149,7 +172,7 @@ def get_city(message: types.Message, bot) -> None:
         cities: List = find_city(city, message)
         if len(cities) == 0:
             msg = bot.send_message(message.chat.id, 'Ничего не найдено\nПопробуйте ввести название более точно:')
-            bot.register_next_step_handler(msg, get_city, bot)
+            bot_steps.register_next_step(msg, get_city, bot)
         elif len(cities) > 1:
             places: List[Tuple] = [(city + ',' + ''.join(one_city[0].split(sep=',')[1:]), one_city[1] + '.city')
                       for one_city in cities]
@@ -176,6 +199,7 @@ def find_city(city: str, message: types.Message) -> List[Tuple]:
     return cities
 
 
+@bot_metrics.handler
 def get_start(location: str, message, bot) -> None:
     """
     Производит запись полученного из get_city значения в базу данных
@@ -190,9 +214,10 @@ def get_start(location: str, message, bot) -> None:
     bot.send_message(message.chat.id, hotel_messages[state][0])
     bot.send_message(message.chat.id, 'Введите количество отелей для поиска.\n'
                                       'Замечу, что я могу найти не более 25 отелей.')
-    bot.register_next_step_handler(message, hotel_numbers, bot, location)
+    bot_steps.register_next_step(message, hotel_numbers, bot, location)
 
 
+@bot_steps.step
 def hotel_numbers(message, bot, location: str) -> None:
     """
     Производит запись полученного от пользователя значения в базу данных
@@ -208,24 +233,25 @@ def hotel_numbers(message, bot, location: str) -> None:
         hot_num = message.text
         if not hot_num.isdigit():
             bot.send_message(message.from_user.id, 'Неправильный ввод, попробуйте еще раз')
-            bot.register_next_step_handler(message, hotel_numbers, bot, location)
+            bot_steps.register_next_step(message, hotel_numbers, bot, location)
         elif 0 >= int(hot_num) or int(hot_num) > 25:
             bot.send_message(message.from_user.id, 'Похоже, вы ввели неправильное количество отелей. Попробуйте снова.')
-            bot.register_next_step_handler(message, hotel_numbers, bot, location)
+            bot_steps.register_next_step(message, hotel_numbers, bot, location)
         else:
             bot_database.update_record('hot_num', hot_num, message.chat.id)
             state = bot_database.select_some(message.chat.id, 'Session', 'state')[0]
-            logger.info(f'После выбора отелей проверка критерия поиска: {state}')
+            logger.info('После выбора отелей проверка критерия поиска: {}', state)
             if state == 'best':
                 logger.info('Переход на запрос расстояния')
                 msg = bot.send_message(message.from_user.id, 'Какое должно быть максимальное расстояние '
                                                              'от отеля до центра города?')
-                bot.register_next_step_handler(msg, get_landmarks, bot)
+                bot_steps.register_next_step(msg, get_landmarks, bot)
             else:
                 msg = bot.send_message(message.from_user.id, 'Сколько человек планирует проживать в отеле?')
-                bot.register_next_step_handler(msg, get_person, bot)
+                bot_steps.register_next_step(msg, get_person, bot)
 
 
+@bot_steps.step
 @logger.catch()
 def get_landmarks(message: types.Message, bot):
     """
@@ -243,13 +269,14 @@ def get_landmarks(message: types.Message, bot):
             msg = bot.send_message(message.from_user.id, 'Неправильный ввод. '
                                                          'Какое должно быть максимальное расстояние '
                                                          'от отеля до центра города?')
-            bot.register_next_step_handler(msg, get_landmarks, bot)
+            bot_steps.register_next_step(msg, get_landmarks, bot)
         else:
             bot_database.update_record('distance', distance, message.chat.id)
             msg = bot.send_message(message.from_user.id, 'Какова должна быть максимальная стоимость суток проживания?')
-            bot.register_next_step_handler(msg, get_max_price, bot)
+            bot_steps.register_next_step(msg, get_max_price, bot)
 
 
+@bot_steps.step
 def get_max_price(message: types.Message, bot) -> None:
     """
     Участвует только в цепочке /bestdeal
@@ -265,13 +292,14 @@ def get_max_price(message: types.Message, bot) -> None:
         if not max_price.isdigit():
             msg = bot.send_message(message.from_user.id, 'Неправильный ввод. '
                                                          'Какова должна быть максимальная стоимость суток проживания?')
-            bot.register_next_step_handler(msg, get_max_price, bot)
+            bot_steps.register_next_step(msg, get_max_price, bot)
         else:
             bot_database.update_record('stop_price', max_price, message.chat.id)
             msg = bot.send_message(message.from_user.id, 'Сколько человек планирует проживать в отеле?')
-            bot.register_next_step_handler(msg, get_person, bot)
+            bot_steps.register_next_step(msg, get_person, bot)
 
 
+@bot_steps.step
 def get_person(message: types.Message, bot) -> None:
     """
     Сохраняет количество проживающих в базу. Вызывет создание inline-клавиатуры-календаря для получения дат
@@ -283,10 +311,16 @@ def get_person(message: types.Message, bot) -> None:
         command_router(bot, message)
     else:
         persons = message.text
-        bot_database.update_record('persons', persons, message.chat.id)
-        show_calendar(bot, message, quest='Выберите дату заезда')
+        if not persons.isdigit() or int(persons) < 1:
+            msg = bot.send_message(message.from_user.id, 'Неправильный ввод. '
+                                                         'Сколько человек планирует проживать в отеле?')
+            bot_steps.register_next_step(msg, get_person, bot)
+        else:
+            bot_database.update_record('persons', persons, message.chat.id)
+            show_calendar(bot, message, quest='Выберите дату заезда')
 
 
+@bot_steps.step
 def get_check_in(message: types.Message, bot, location: str, hot_num: str, persons: str) -> None:
     """
     Функция в данный момент не используется. Сохранена для будущей работы.
@@ -303,7 +337,7 @@ def get_check_in(message: types.Message, bot, location: str, hot_num: str, perso
         check_in = message.text
         bot_database.update_record('check_in', check_in, message.chat.id)
         msg = bot.send_message(message.chat.id, 'Когда планируется выезд из в отеля?')
-        bot.register_next_step_handler(msg, get_check_out, bot, location, hot_num, persons, check_in)
+        bot_steps.register_next_step(msg, get_check_out, bot, location, hot_num, persons, check_in)
 
 
 # def get_currency(message, bot, location, hot_num, persons, check_in):
@@ -312,6 +346,7 @@ def get_check_in(message: types.Message, bot, location: str, hot_num: str, perso
 #     bot.register_next_step_handler(msg, find_hotels, bot, location, hot_num, persons, check_in, check_out)
 
 
+@bot_steps.step
 def get_check_out(message: types.Message, bot, currency: str='RUB') -> None:
     """
     Получает список отелей по заданным критериям. Вызыввет show_hotels для вывода списка пользователю.
@@ -336,20 +371,23 @@ def get_check_out(message: types.Message, bot, currency: str='RUB') -> None:
                                        sorting_method, lang, currency, max_price, distance)
         hotels_list = searched_hotels.get_hotels()
         if hotels_list:
-            hotels_history = json.dumps(hotels_list, ensure_ascii=False)
-            logger.info('Получен список отелей:')
-            logger.info(hotels_history)
+            hotels_history = HotelRecord.dump(hotels_list)
+            bot_logging.log_payload('DEBUG', 'Получен список отелей', hotels_history)
             bot_database.create_history(message.chat.id, hotels_history, tm_stamp)
             show_hotels(message.chat.id, hotels_list)
+            for one_hotel in hotels_list[:bot_settings.PREFETCH_ON_LIST]:
+                bot_prefetch.prefetch_hotel(my_rapi, one_hotel.id, check_in, check_out, persons, currency, lang)
         else:
-            logger.warning('Список отелей не получен', message.chat.id)
+            logger.warning('Список отелей не получен, chat.id: {}', message.chat.id)
             bot.send_message(message.chat.id, 'К сожалению, ни одного отеля не найдено')
 
 
+@bot_metrics.handler
 def chosen_hotel(hotel_id: str, call: types.CallbackQuery, bot, currency: str='RUB') -> None:
     """
     Выводит пользователю информацию по выбранному отелю. Предлагает на выбор вывод изображений отеля,
     либо просмотр рещультатов последнего запроса.
+    Информация и изображения отеля запрашиваются одновременно в пуле потоков, пока из базы читается история.
     :param hotel_id: id выбранного пользователем отеля
     :param call: вызов из inline -клавиатуры
     :param bot: чат-бот
@@ -357,17 +395,14 @@ def chosen_hotel(hotel_id: str, call: types.CallbackQuery, bot, currency: str='R
     """
     persons, check_out, check_in, lang = bot_database.select_some(
         call.message.chat.id, 'Session', 'persons', 'check_out', 'check_in', 'lang')
-    logger.info(f'переменные для конкретного отеля: {call.message.chat.id}, {persons}, {check_out}, {check_in}, {lang}')
-    one_hotel = ApiQuest(my_rapi, hotel_id, check_in, check_out, persons, currency, lang)
-    hotel_info = one_hotel.get_one_hotel()
+    logger.debug('переменные для конкретного отеля: {}, {}, {}, {}, {}', call.message.chat.id, persons, check_out,
+                 check_in, lang)
+    bot_prefetch.prefetch_hotel(my_rapi, hotel_id, check_in, check_out, persons, currency, lang)
     hotels = bot_database.select_some(call.message.chat.id, 'History', 'hotels')[0]
-    hotels_list = json.loads(hotels)
-    for one_hotel in hotels_list:
-        if one_hotel[1].split(sep='.')[0] == hotel_id:
-            distance = one_hotel[0].split(sep='\n')[-2]
-            if lang == 'en_US':
-                distance = round(float(distance) * 1.609, 2)
-            hotel_info += f'\nРасстояние до центра города: {distance} км.'
+    hotel_info = bot_prefetch.get_info(my_rapi, hotel_id, check_in, check_out, persons, currency, lang)
+    one_hotel = HotelRecord.load(hotels).get(hotel_id)
+    if one_hotel is not None:
+        hotel_info += f'\nРасстояние до центра города: {one_hotel.distance_km} км.'
     bot.send_message(call.message.chat.id, hotel_info)
     bot.send_message(call.message.chat.id, f'https://ru.hotels.com/ho{hotel_id}')
     next_step: List = [('Изображения отеля', hotel_id + '.h_pic'),
@@ -377,6 +412,7 @@ def chosen_hotel(hotel_id: str, call: types.CallbackQuery, bot, currency: str='R
     bot.send_message(call.message.chat.id, text='Выберите действие: ', reply_markup=keyboard)
 
 
+@bot_metrics.handler
 def set_date(call: types.CallbackQuery) -> None:
     """
     Получает даты заезда и выезда, записывает их в базу данных
@@ -399,10 +435,9 @@ def set_date(call: types.CallbackQuery) -> None:
             logger.info('определена дата заезда')
     else:
         chk_in = bot_database.select_some(call.message.chat.id, 'Session', 'check_in')[0]
-        logger.info(chk_in)
+        logger.debug('Дата заезда: {}', chk_in)
         if chk_in:
-            c_year, c_month, c_day = map(int, chk_in.split(sep='-'))
-            if datetime.date(int(c_year), int(c_month), int(c_day)) < datetime.date(int(year), int(month), int(day)):
+            if chk_in < datetime.date(int(year), int(month), int(day)):
                 this_date = f'{year}-{month}-{day}'
                 stage = 'check_out'
                 proper = True
@@ -425,21 +460,22 @@ def set_date(call: types.CallbackQuery) -> None:
         show_calendar(bot, call.message, quest=f'Выберите дату {action_now}', name=name)
 
 
+@bot_metrics.handler
 def show_hotels(chat_id: int, hotels: List, question: str = 'Отели найдены. Выберите подходящий:') -> None:
     """
     Выводит inline-клавиатуру со списком отелей, попавших в критерии, указанные пользователем.
     Выделена в отдельную функцию для удобства показа результата последнего запроса.
     :param chat_id: id чата, в котором происходит взаимодействие с пользователем
-    :param hotels: Список, содержащий списки/кортежи, содержащие id и описание отелей, подходящих критериям пользователя
+    :param hotels: Список записей об отелях, подходящих критериям пользователя
     :param question: вопрос, задаваемый пользователю
     """
-    logger.info('Вход в функцию show_hotels')
-    logger.info(hotels)
-    this_keyboard = BotKeyboard(hotels, 1)
+    bot_logging.log_payload('DEBUG', 'Вход в функцию show_hotels', hotels)
+    this_keyboard = BotKeyboard([one_hotel.button() for one_hotel in hotels], 1)
     keyboard = this_keyboard.create_keys()
     bot.send_message(chat_id, text=question, reply_markup=keyboard)
 
 
+@bot_metrics.handler
 def get_picts(hot_id: str, message: types.Message, bot, p_type: str) -> None:
     """
     Запрашивает у пользователя количество выводимых изображений отеля.
@@ -450,9 +486,10 @@ def get_picts(hot_id: str, message: types.Message, bot, p_type: str) -> None:
     """
     msg = bot.send_message(message.chat.id, 'Сколько изображений вывести?\n'
                                            'Замечу, что я могу вывести не более 10 изображений.')
-    bot.register_next_step_handler(msg, show_picts, hot_id, bot, p_type)
+    bot_steps.register_next_step(msg, show_picts, hot_id, bot, p_type)
 
 
+@bot_steps.step
 def show_picts(message: types.Message, hot_id: str, bot, p_type: str) -> None:
     """
     Получает и выводит изображения отеля
@@ -465,36 +502,53 @@ def show_picts(message: types.Message, hot_id: str, bot, p_type: str) -> None:
     if not picts_quont.isdigit() or int(picts_quont) < 1 or int(picts_quont) > 10:
         msg = bot.send_message(message.chat.id, 'Неправильный ввод. \nСколько изображений вывести?\n'
                                            'Замечу, что я могу вывести не более 10 изображений.')
-        bot.register_next_step_handler(msg, show_picts, hot_id, bot, p_type)
+        bot_steps.register_next_step(msg, show_picts, hot_id, bot, p_type)
     else:
-        logger.info('Получен id отеля для показа изображений')
-        logger.info(hot_id)
+        logger.info('Получен id отеля для показа изображений: {}', hot_id)
         if p_type == 'h_pic':
-            one_hotel = ApiQuest(my_rapi, hot_id)
-            logger.info('Отправлен запрос на получение изображений отеля')
-            hotel_pics = one_hotel.get_hotel_pics()
-            logger.info('Получен список url изображений отеля')
-            logger.info(hotel_pics)
-            for index, one_pict in enumerate(hotel_pics):
-                if index < int(message.text):
-                    final_pic = one_pict.replace('{size}', 'z')
-                    bot.send_photo(chat_id=message.chat.id, photo=final_pic)
-                    time.sleep(0.1)
-                else:
-                    break
+            logger.info('Запрошены изображения отеля')
+            hotel_pics = bot_prefetch.get_pics(my_rapi, hot_id)
+            bot_logging.log_payload('DEBUG', 'Получен список url изображений отеля', hotel_pics)
+            send_picts(bot, message.chat.id, hotel_pics[:int(picts_quont)])
         next_step: List = [('Показать последний запрос', str(message.chat.id) + '.his')]
         this_keyboard = BotKeyboard(next_step, 1)
         keyboard = this_keyboard.create_keys()
         bot.send_message(message.chat.id, text='Выберите действие: ', reply_markup=keyboard)
 
 
+@bot_metrics.handler
+def send_picts(bot, chat_id: int, pictures: List[str], size: str = bot_settings.PICS_SIZE) -> None:
+    """
+    Отправляет изображения одним альбомом (media group). Если Telegram отклонил альбом,
+    отправляет изображения по одному, пропуская те, которые отправить не удалось.
+    При включенной очереди отправки (bot_outbox) альбом по одному изображению отправляет очередь.
+    :param bot: чат-бот
+    :param chat_id: id чата, в котором происходит взаимодействие с пользователем
+    :param pictures: список url изображений с шаблоном {size}
+    :param size: вариант размера изображения, подставляемый вместо {size}
+    """
+    final_picts: List[str] = [one_pict.replace('{size}', size) for one_pict in pictures]
+    if len(final_picts) > 1:
+        try:
+            bot.send_media_group(chat_id, [types.InputMediaPhoto(one_pict) for one_pict in final_picts])
+            return
+        except Exception as err:
+            logger.warning('Не удалось отправить альбом изображений: {}', err)
+    for one_pict in final_picts:
+        try:
+            bot.send_photo(chat_id=chat_id, photo=one_pict)
+        except Exception as err:
+            logger.warning('Не удалось отправить изображение {}: {}', one_pict, err)
+
+
+@bot_metrics.handler
 def show_history(message: types.Message) -> None:
     """
     Показывает легенду и результат последнего запроса пользователя
     :param message: Полученное в чате сообщение
     """
     hotels, tm_stamp = bot_database.select_some(message.chat.id, 'History', 'hotels', 't_stamp')
-    hotels_list = json.loads(hotels)
+    hotels_list = list(HotelRecord.load(hotels).values())
     when = datetime.datetime.fromtimestamp(tm_stamp).strftime('%Y-%m-%d %H:%M')
     persons, city, hot_num, check_out, check_in, sorting_m, lang = bot_database.select_history(
         message.chat.id, tm_stamp, 'persons', 'city', 'hot_num',
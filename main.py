@@ -1,42 +1,47 @@
 import telebot
 import bots_funcs
-import os
+import bot_settings
+import bot_logging
+import bot_metrics
+import bot_webhook
+import bot_steps
+import bot_retention
 import atexit
-from dotenv import load_dotenv
 from loguru import logger
-from bot_database import create_tables
-
-load_dotenv()
-my_token = os.getenv('BOT_TOKEN')
-my_rapi = os.getenv('RAPI_TOKEN')
+from bot_database import create_tables, start_session_migration
+from bot_state import session_store
+from bot_core import bot
 
 @atexit.register
 def goodbye() -> None:
     """
-    Выводит сообщение при выходе
+    Сохраняет сессии в базу данных, выводит сообщение при выходе и дожидается записи лога
     """
+    session_store.stop()
+    if getattr(bot, 'outbox', None) is not None:
+        bot.outbox.close(bot_settings.OUTBOX_CLOSE_TIMEOUT)
     logger.info('Завершение')
-
-
-bot = telebot.TeleBot(my_token)
+    bot_logging.flush()
 
 
 @bot.message_handler(commands=['start', 'help', 'lowprice', 'highprice', 'bestdeal'])
 def get_commands(message: telebot.types.Message) -> None:
     """
-    Обработчик зарегистрированных команд
+    Обработчик зарегистрированных команд. Команда прерывает текущую цепочку опроса.
     :param message: Полученное в чате сообщение
     """
+    bot_steps.clear_step(message.chat.id)
     bots_funcs.command_router(bot, message)
 
 
 @bot.message_handler(content_types=['text'])
 def get_text_messages(message: telebot.types.Message) -> None:
     """
-    Обработчик текстовых сообщений
+    Обработчик текстовых сообщений. Если для чата назначен шаг цепочки опроса, сообщение передается ему.
     :param message: Полученное в чате сообщение
     """
-    bots_funcs.command_router(bot, message)
+    if not bot_steps.resume_step(bot, message):
+        bots_funcs.command_router(bot, message)
 
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -45,8 +50,7 @@ def callback_worker(call: telebot.types.CallbackQuery) -> None:
     Обработчик событий inline-клавиатуры
     :param call: сообщение от inline-клавиатуры
     """
-    logger.info(f'call {call.from_user.id}')
-    logger.info(call.data)
+    logger.info('call {}: {}', call.from_user.id, call.data)
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
     if call.data.startswith('calendar'):
         name, action, year, month, day = call.data.split(':')
@@ -57,7 +61,7 @@ def callback_worker(call: telebot.types.CallbackQuery) -> None:
                 month = str(int(month) + 1)
             elif action == 'PREVIOUS-MONTH':
                 month = str(int(month) - 1)
-            bots_funcs.show_calendar(bot, call.message, int(month), name=name)
+            bots_funcs.show_calendar(bot, call.message, int(month), name=name, year=int(year))
     else:
         capt_list = call.data.split(sep='.')
         if capt_list[1] == 'loc':
@@ -74,8 +78,17 @@ def callback_worker(call: telebot.types.CallbackQuery) -> None:
 
 if __name__ == '__main__':
 
-    logger.add('hotel_logging.log', rotation="100 MB", encoding='utf-8')
+    bot_logging.setup()
     logger.info('Bot is starting')
     create_tables('Session')
     create_tables('History')
-    bot.polling(none_stop=True, interval=0)
+    create_tables('HistoryArchive')
+    create_tables('NextStep')
+    start_session_migration()
+    bot_retention.start()
+    bot_metrics.start()
+    session_store.start()
+    if bot_settings.BOT_RUNTIME == 'webhook':
+        bot_webhook.run(bot)
+    else:
+        bot.polling(none_stop=True, interval=0)
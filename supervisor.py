@@ -0,0 +1,303 @@
+import datetime
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+from loguru import logger
+from telebot import apihelper
+import bot_logging
+import bot_settings
+
+
+def update_chat_id(update: Dict) -> int:
+    """
+    Определяет id чата по обновлению Telegram в виде словаря
+    :param update: обновление
+    :return: id чата, либо id пользователя или обновления, если чата в обновлении нет
+    """
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if kind in update:
+            return update[kind]['chat']['id']
+    callback = update.get('callback_query')
+    if callback is not None:
+        if callback.get('message'):
+            return callback['message']['chat']['id']
+        return callback['from']['id']
+    return update['update_id']
+
+
+def shard_of(update: Dict, shards: int) -> int:
+    """
+    Возвращает номер процесса, который обрабатывает чат обновления.
+    Используется crc32, а не hash(), чтобы распределение не зависело от запуска интерпретатора.
+    :param update: обновление
+    :param shards: количество процессов
+    :return: номер процесса
+    """
+    return zlib.crc32(str(update_chat_id(update)).encode()) % shards
+
+
+def bot_worker(shard: int, updates: multiprocessing.Queue, ready,
+               finished: Optional[Callable[[], None]] = None) -> None:
+    """
+    Процесс-обработчик. Получает обновления своих чатов и передает их обработчикам бота.
+    Сессии чатов хранятся в памяти процесса, журнал сессий у каждого процесса свой.
+    :param shard: номер процесса
+    :param updates: очередь обновлений процесса
+    :param ready: событие, устанавливаемое после запуска процесса
+    :param finished: функция, вызываемая после завершения обработчиков всех полученных обновлений,
+    до остановки очереди отправки и записи сессий
+    """
+    from telebot import types
+    import bot_metrics
+    from bot_state import session_store
+    import main
+    bot_logging.setup(f'{bot_settings.LOG_FILE}.{shard}' if bot_settings.LOG_FILE else '')
+    session_store.journal = f'{session_store.journal}.{shard}'
+    session_store.start()
+    bot_metrics.start(shard)
+    ready.set()
+    logger.info('Процесс {} запущен', shard)
+    try:
+        while True:
+            update = updates.get()
+            if update is None:
+                break
+            main.bot.process_new_updates([types.Update.de_json(update)])
+    finally:
+        main.bot.worker_pool.close()
+        if finished is not None:
+            finished()
+        if getattr(main.bot, 'outbox', None) is not None:
+            main.bot.outbox.close(bot_settings.OUTBOX_CLOSE_TIMEOUT)
+        session_store.stop()
+        bot_logging.flush()
+
+
+def start_workers(target: Callable, workers: int, *args: Any) -> List:
+    """
+    Запускает процессы-обработчики и дожидается их готовности
+    :param target: функция процесса, принимает номер процесса, его очередь, событие готовности и args
+    :param workers: количество процессов
+    :param args: дополнительные аргументы функции процесса
+    :return: список пар (процесс, очередь)
+    """
+    context = multiprocessing.get_context('spawn')
+    shards = []
+    events = []
+    for shard in range(workers):
+        updates = context.Queue(maxsize=bot_settings.SHARD_QUEUE_SIZE)
+        ready = context.Event()
+        process = context.Process(target=target, args=(shard, updates, ready, *args), name=f'shard-{shard}', daemon=True)
+        process.start()
+        shards.append((process, updates))
+        events.append(ready)
+    for (process, _), ready in zip(shards, events):
+        while not ready.wait(1):
+            if not process.is_alive():
+                raise RuntimeError(f'Процесс {process.name} завершился при запуске с кодом {process.exitcode}')
+    return shards
+
+
+def send_update(shard: tuple, update: Optional[Dict]) -> None:
+    """
+    Передает обновление в очередь процесса. Если очередь заполнена, проверяет, что процесс еще работает:
+    очередь завершившегося процесса никто не читает, и ожидание места в ней остановило бы получение обновлений.
+    :param shard: пара (процесс, очередь)
+    :param update: обновление, None - сигнал остановки процесса
+    """
+    process, updates = shard
+    while True:
+        try:
+            updates.put(update, timeout=1)
+            return
+        except queue.Full:
+            if not process.is_alive():
+                raise RuntimeError(f'Процесс {process.name} завершился с кодом {process.exitcode}')
+
+
+def check_workers(shards: List) -> None:
+    """
+    Проверяет, что все процессы-обработчики работают
+    :param shards: список пар (процесс, очередь)
+    """
+    for process, _ in shards:
+        if not process.is_alive():
+            raise RuntimeError(f'Процесс {process.name} завершился с кодом {process.exitcode}')
+
+
+def stop_workers(shards: List) -> None:
+    """
+    Останавливает процессы-обработчики после обработки уже полученных обновлений
+    :param shards: список пар (процесс, очередь)
+    """
+    for shard in shards:
+        try:
+            send_update(shard, None)
+        except RuntimeError as err:
+            logger.error('{}', err)
+    for process, _ in shards:
+        process.join()
+
+
+def run(token: str, workers: int) -> None:
+    """
+    Запускает бота в нескольких процессах. Супервизор получает обновления от Telegram
+    и передает каждое в процесс, выбранный по хэшу id чата, поэтому все сообщения чата
+    обрабатывает один и тот же процесс. Если процесс-обработчик завершился, супервизор
+    останавливает остальные процессы и завершается с ошибкой: перезапуск выполняет внешний менеджер
+    процессов, а неподтвержденные обновления Telegram отправит повторно.
+    :param token: токен бота
+    :param workers: количество процессов
+    """
+    import bot_retention
+    from bot_database import create_tables, start_session_migration
+    create_tables('Session')
+    create_tables('History')
+    create_tables('HistoryArchive')
+    create_tables('NextStep')
+    start_session_migration()
+    bot_retention.start()
+    # Ограничение частоты отправки действует на весь бот, поэтому делится между процессами.
+    # Процессы запускаются через spawn и читают настройки из окружения заново
+    os.environ['OUTBOX_GLOBAL_RATE'] = str(bot_settings.OUTBOX_GLOBAL_RATE / workers)
+    shards = start_workers(bot_worker, workers)
+    logger.info('Запущено процессов: {}', workers)
+    offset: Optional[int] = None
+    try:
+        while True:
+            check_workers(shards)
+            try:
+                updates = apihelper.get_updates(token, offset=offset, timeout=20, long_polling_timeout=20)
+            except Exception as err:
+                logger.warning('Ошибка при получении обновлений: {}', err)
+                time.sleep(1)
+                continue
+            for update in updates:
+                send_update(shards[shard_of(update, workers)], update)
+                offset = update['update_id'] + 1
+    except KeyboardInterrupt:
+        logger.info('Остановка процессов')
+    finally:
+        stop_workers(shards)
+
+
+def bench_worker(shard: int, updates: multiprocessing.Queue, ready, results: multiprocessing.Queue) -> None:
+    """
+    Процесс-обработчик нагрузочного теста: тот же bot_worker, но сообщения вместо Telegram
+    принимает замена чат-бота FakeBot из bot_bench.py, а запросы к API выполняются к собственной
+    локальной замене API процесса, поэтому процессы не ждут друг друга на одном сервере.
+    Когда обработчики всех полученных обновлений завершены, процесс передает в results
+    свой номер и количество запросов списка отелей.
+    :param shard: номер процесса
+    :param updates: очередь обновлений процесса
+    :param ready: событие, устанавливаемое после запуска процесса
+    :param results: очередь результатов процессов
+    """
+    import bot_bench
+    import bot_outbox
+    from bot_core import bot
+    api = bot_bench.FakeApi(bot_settings.SHARD_BENCH_API_LATENCY, 5, 10)
+    bot_settings.API_BASE_URL = api.start()
+    fake_bot = bot_bench.FakeBot(0)
+    for method in bot_outbox.METHODS:
+        setattr(bot, method, getattr(fake_bot, method))
+    try:
+        bot_worker(shard, updates, ready, lambda: results.put((shard, api.calls['/properties/list'])))
+    finally:
+        api.stop()
+
+
+def bench_updates(chat_id: int, first_id: int, city: str) -> List[Dict]:
+    """
+    Создает обновления Telegram для цепочки поиска /lowprice одного чата: от команды до вывода списка отелей
+    :param chat_id: id чата
+    :param first_id: update_id первого обновления
+    :param city: название города
+    :return: список обновлений
+    """
+    check_in = datetime.date.today() + datetime.timedelta(days=1)
+    check_out = check_in + datetime.timedelta(days=3)
+    sender = {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}, 'from': sender}
+    call = {'id': str(chat_id), 'from': sender, 'chat_instance': str(chat_id),
+            'message': dict(message, text='Выберите действие')}
+    steps = [{'message': dict(message, text='/lowprice')}, {'callback_query': dict(call, data='ru_RU.loc')}]
+    steps += [{'message': dict(message, text=text)} for text in (city, '10', '2')]
+    steps += [{'callback_query': dict(call, data=f'{name}:DAY:{day.year}:{day.month}:{day.day}')}
+              for name, day in (('calendar_1', check_in), ('calendar_2', check_out))]
+    return [dict(update, update_id=first_id + number) for number, update in enumerate(steps)]
+
+
+def load_test(workers: int, searches: int) -> float:
+    """
+    Нагрузочный тест: workers процессов bot_worker обрабатывают цепочки поиска searches чатов.
+    Обновления проходят тот же путь, что и при работе бота: распределение по процессам,
+    process_new_updates, обработчики main.py, база данных и запросы к локальной замене API.
+    Время измеряется от передачи первого обновления до сообщения последнего процесса о том,
+    что его обработчики завершены; остановка процессов в него не входит.
+    :param workers: количество процессов
+    :param searches: количество цепочек поиска
+    :return: пропускная способность, поисков в секунду
+    """
+    from bot_classes import db, db_pragmas
+    from bot_database import create_tables
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as folder:
+        os.environ.update({'DB_PATH': os.path.join(folder, 'bench.db'),
+                           'SESSION_JOURNAL': os.path.join(folder, 'journal.log'), 'OUTBOX_WORKERS': '0',
+                           'LOG_FILE': '', 'LOG_LEVEL': 'WARNING', 'METRICS_PORT': '0', 'METRICS_FILE': '',
+                           'BOT_TOKEN': os.getenv('BOT_TOKEN') or '0:bench'})
+        db.init(os.environ['DB_PATH'], pragmas=db_pragmas(), timeout=bot_settings.DB_BUSY_TIMEOUT)
+        for one_model in ('Session', 'History', 'NextStep'):
+            create_tables(one_model)
+        db.close()
+        shards = start_workers(bench_worker, workers, results)
+        updates = [update for chat_id in range(1, searches + 1)
+                   for update in bench_updates(chat_id, chat_id * 100, f'город{chat_id % 20}')]
+        list_calls = 0
+        done = set()
+        try:
+            started = time.perf_counter()
+            for update in updates:
+                send_update(shards[shard_of(update, workers)], update)
+            for shard in shards:
+                send_update(shard, None)
+            while len(done) < workers:
+                try:
+                    shard, calls = results.get(timeout=1)
+                except queue.Empty:
+                    check_workers([one_shard for number, one_shard in enumerate(shards) if number not in done])
+                    continue
+                done.add(shard)
+                list_calls += calls
+            elapsed = time.perf_counter() - started
+        except BaseException:
+            for process, _ in shards:
+                process.terminate()
+            raise
+        finally:
+            for process, _ in shards:
+                process.join()
+    if list_calls == 0:
+        raise RuntimeError('Ни одна цепочка поиска не дошла до запроса списка отелей')
+    return searches / elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        print(f'ядер процессора: {os.cpu_count()}')
+        baseline = None
+        for workers in [int(number) for number in sys.argv[2:]] or [1, 2, 4]:
+            throughput = load_test(workers, bot_settings.SHARD_BENCH_SEARCHES)
+            baseline = baseline or throughput / workers
+            print(f'процессов: {workers}, поисков в секунду: {throughput:.1f}, '
+                  f'ускорение: {throughput / baseline:.2f}')
+    else:
+        bot_logging.setup()
+        run(os.getenv('BOT_TOKEN'), bot_settings.SHARD_WORKERS)